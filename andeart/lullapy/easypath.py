@@ -1,16 +1,59 @@
-from pathlib import Path
+import fnmatch
+import os
+import stat
+import threading
+from pathlib import Path, PurePath
 
 
 class EasyPath:
+    # While the stat cache is enabled, maps each absolute path that was checked to its stat result, or None if it did
+    # not exist.
+    __stat_cache = None
+    __stat_cache_lock = threading.Lock()
+    __glob_magic_chars = frozenset("*?[")
+
+
+    @staticmethod
+    def enable_stat_cache():
+        # Opt-in, for tools that check the same paths over and over in one run: is_file, is_dir and get_directory then
+        # stat each path only once. Whatever writes to, creates or deletes a path must call invalidate afterwards.
+        with EasyPath.__stat_cache_lock:
+            if EasyPath.__stat_cache is None:
+                EasyPath.__stat_cache = {}
+
+
+    @staticmethod
+    def disable_stat_cache():
+        with EasyPath.__stat_cache_lock:
+            EasyPath.__stat_cache = None
+
+
+    @staticmethod
+    def invalidate(location = None):
+        # Forgets the cached stat of location and of everything under it, or of every path if location is None.
+        with EasyPath.__stat_cache_lock:
+            if EasyPath.__stat_cache is None:
+                return
+            if location is None:
+                EasyPath.__stat_cache.clear()
+                return
+            key = EasyPath.__get_stat_key(location)
+            prefix = key.rstrip(os.sep) + os.sep
+            for cached_key in [cached_key for cached_key in EasyPath.__stat_cache
+                               if cached_key == key or cached_key.startswith(prefix)]:
+                del EasyPath.__stat_cache[cached_key]
+
 
     @staticmethod
     def is_dir(location):
-        return Path(location).is_dir()
+        location_stat = EasyPath.__stat(location)
+        return location_stat is not None and stat.S_ISDIR(location_stat.st_mode)
 
 
     @staticmethod
     def is_file(location):
-        return Path(location).is_file()
+        location_stat = EasyPath.__stat(location)
+        return location_stat is not None and stat.S_ISREG(location_stat.st_mode)
 
 
     @staticmethod
@@ -34,18 +77,95 @@ class EasyPath:
     @staticmethod
     def get_directory(location):
         strong_path = Path(location)
-        if strong_path.is_file():
+        if EasyPath.is_file(strong_path):
             return strong_path.parent
-        if strong_path.is_dir():
+        if EasyPath.is_dir(strong_path):
             return strong_path
         return None
 
 
     @staticmethod
     def glob(root_location, file_pattern):
-        return Path(root_location).glob(file_pattern)
+        # Yields matching paths as the directories are scanned, so callers can start on the first match before the walk
+        # finishes. Each wildcard level (ex: the "*" in "*/packages.config") costs one scandir per directory, and levels
+        # without wildcards are joined on without listing anything. Recursive "**" patterns are left to pathlib.
+        pattern_path = PurePath(str(file_pattern).replace("\\", "/"))
+        parts = pattern_path.parts
+        if pattern_path.anchor:
+            # Absolute patterns (ex: "/abs/*/x") are walked from their anchor, whatever root_location is.
+            root_location = pattern_path.anchor
+            parts = parts[1:]
+            if not parts or "**" in parts:
+                return Path(root_location).glob("/".join(parts))
+        elif not parts or "**" in parts:
+            return Path(root_location).glob(str(file_pattern))
+        return EasyPath.__glob_parts(Path(root_location), list(parts))
 
 
     @staticmethod
     def glob_cwd(file_pattern):
-        return Path.cwd().glob(str(file_pattern))
+        return EasyPath.glob(Path.cwd(), file_pattern)
+
+
+    @staticmethod
+    def __glob_parts(dir_path, parts):
+        (part, remaining_parts) = (parts[0], parts[1:])
+        if EasyPath.__glob_magic_chars.isdisjoint(part):
+            path = dir_path.joinpath(part)
+            if not remaining_parts:
+                if os.path.lexists(path):
+                    yield path
+            elif os.path.isdir(path):
+                yield from EasyPath.__glob_parts(path, remaining_parts)
+            return
+
+        try:
+            with os.scandir(dir_path) as entries:
+                # Entries are listed up front, so the directory is not held open while deeper levels are walked.
+                names = [entry.name for entry in entries if fnmatch.fnmatch(entry.name, part) and
+                         (not remaining_parts or EasyPath.__is_dir_entry(entry))]
+        except OSError:
+            return
+        for name in names:
+            path = dir_path.joinpath(name)
+            if remaining_parts:
+                yield from EasyPath.__glob_parts(path, remaining_parts)
+            else:
+                yield path
+
+
+    @staticmethod
+    def __is_dir_entry(entry):
+        try:
+            return entry.is_dir()
+        except OSError:
+            return False
+
+
+    @staticmethod
+    def __get_stat_key(location):
+        return os.path.abspath(os.fspath(location))
+
+
+    @staticmethod
+    def __stat(location):
+        # Returns None for paths that do not exist or cannot be checked, as pathlib's is_file and is_dir do.
+        if EasyPath.__stat_cache is None:
+            return EasyPath.__stat_uncached(location)
+        key = EasyPath.__get_stat_key(location)
+        with EasyPath.__stat_cache_lock:
+            if EasyPath.__stat_cache is not None and key in EasyPath.__stat_cache:
+                return EasyPath.__stat_cache[key]
+        location_stat = EasyPath.__stat_uncached(key)
+        with EasyPath.__stat_cache_lock:
+            if EasyPath.__stat_cache is not None:
+                EasyPath.__stat_cache[key] = location_stat
+        return location_stat
+
+
+    @staticmethod
+    def __stat_uncached(location):
+        try:
+            return os.stat(location)
+        except (OSError, ValueError):
+            return None
@@ -0,0 +1,125 @@
+import ctypes
+import ctypes.util
+import os
+import select
+import struct
+import sys
+import time
+
+
+class FileWatcher:
+    # Watches a directory for changes to a set of file names. Uses inotify on Linux, so that waiting costs no CPU, and
+    # polls the directory elsewhere (or when inotify is unavailable).
+    # Flags and masks from sys/inotify.h.
+    __in_cloexec = 0o2000000
+    __in_modify = 0x2
+    __in_close_write = 0x8
+    __in_moved_to = 0x80
+    __in_create = 0x100
+    __in_delete = 0x200
+    __in_delete_self = 0x400
+    __in_move_self = 0x800
+    __in_ignored = 0x8000
+    __event_header = struct.Struct("iIII")
+
+
+    def __init__(self, dir_path, file_names, poll_interval = 1.0):
+        self.__dir_path = str(dir_path)
+        self.__file_names = {os.path.normcase(file_name) for file_name in file_names}
+        self.__poll_interval = poll_interval
+        self.__inotify_fd = self.__init_inotify()
+        self.__snapshot = None if self.__inotify_fd is not None else self.__take_snapshot()
+
+
+    @property
+    def uses_inotify(self):
+        return self.__inotify_fd is not None
+
+
+    def wait_for_changes(self, settle_time = 0.5):
+        # Blocks until any of the watched files changes, then until none of them has changed for settle_time seconds,
+        # so that a burst of writes (ex: a build) is reported once. Returns the names of the changed files.
+        changed_names = set()
+        timeout = None
+        while True:
+            names = self.__read_inotify(timeout) if self.uses_inotify else self.__poll(timeout)
+            if names:
+                changed_names |= names
+                timeout = settle_time
+            elif changed_names:
+                return changed_names
+
+
+    def close(self):
+        if self.__inotify_fd is not None:
+            os.close(self.__inotify_fd)
+            self.__inotify_fd = None
+
+
+    def __init_inotify(self):
+        if not sys.platform.startswith("linux"):
+            return None
+        try:
+            libc = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6", use_errno = True)
+            inotify_fd = libc.inotify_init1(self.__in_cloexec)
+        except (OSError, AttributeError):
+            return None
+        if inotify_fd < 0:
+            return None
+        mask = self.__in_modify | self.__in_close_write | self.__in_moved_to | self.__in_create | self.__in_delete | \
+            self.__in_delete_self | self.__in_move_self
+        if libc.inotify_add_watch(inotify_fd, os.fsencode(self.__dir_path), mask) < 0:
+            os.close(inotify_fd)
+            return None
+        return inotify_fd
+
+
+    def __read_inotify(self, timeout):
+        (readable, _, _) = select.select([self.__inotify_fd], [], [], timeout)
+        if not readable:
+            return set()
+        data = os.read(self.__inotify_fd, 64 * 1024)
+        names = set()
+        offset = 0
+        while offset < len(data):
+            (watch, mask, cookie, name_length) = self.__event_header.unpack_from(data, offset)
+            offset += self.__event_header.size
+            name = os.fsdecode(data[offset:offset + name_length].rstrip(b"\0"))
+            offset += name_length
+            if mask & (self.__in_delete_self | self.__in_move_self | self.__in_ignored):
+                # The watched directory was deleted or moved away (ex: by a clean build), so fall back to polling, which
+                # copes with the directory coming and going. Files already in a new directory are reported as changed,
+                # since the snapshot cannot tell whether they were written before or after it was taken.
+                self.close()
+                self.__snapshot = self.__take_snapshot()
+                return names | self.__snapshot.keys()
+            if os.path.normcase(name) in self.__file_names:
+                names.add(name)
+        return names
+
+
+    def __poll(self, timeout):
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            time.sleep(self.__poll_interval if deadline is None else
+                       max(0.0, min(self.__poll_interval, deadline - time.monotonic())))
+            snapshot = self.__take_snapshot()
+            names = {name for name in snapshot.keys() | self.__snapshot.keys()
+                     if snapshot.get(name) != self.__snapshot.get(name)}
+            self.__snapshot = snapshot
+            if names or (deadline is not None and time.monotonic() >= deadline):
+                return names
+
+
+    def __take_snapshot(self):
+        # Maps each watched file that exists to its size and mtime, from a single directory listing.
+        snapshot = {}
+        try:
+            with os.scandir(self.__dir_path) as entries:
+                for entry in entries:
+                    if os.path.normcase(entry.name) in self.__file_names:
+                        stat = entry.stat()
+                        snapshot[entry.name] = (stat.st_size, stat.st_mtime_ns)
+        except OSError:
+            pass
+        return snapshot
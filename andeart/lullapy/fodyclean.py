@@ -1,12 +1,22 @@
 import argparse
+import collections
+import hashlib
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
 from xml.etree import ElementTree
 
 from andeart.lullapy.easypath import EasyPath
 from andeart.lullapy.processrun import ProcessRunner
 from andeart.lullapy.shyprint import LogLevel, Logger
+from andeart.lullapy.statefile import StateFile
+from andeart.lullapy.traceprofile import TraceProfiler
 
 
 class FodyCleaner:
+    project_file_patterns = ["*/packages.config", "*/*.csproj"]
+    index_file_name = "fodyclean-index.json"
+
 
     # noinspection SpellCheckingInspection
     def __init__(self, silent = False):
@@ -22,20 +32,36 @@ class FodyCleaner:
         parser.add_argument("--slnpath", "-s", type = str, metavar = "SolutionPath", default = None,
                             help = "The path to the solution whose directory (or the path to that directory itself) "
                                    "contains all the targeted projects.")
+        parser.add_argument("--packageids", "-p", type = str, metavar = "PackageIds", default = "Costura.Fody;Fody",
+                            help = "A semicolon-separated list of the package ids to remove from the projects. "
+                                   "Applies \"Costura.Fody;Fody\" by default.")
+        parser.add_argument("--workers", "-w", type = int, metavar = "WorkerCount", default = None,
+                            help = "The number of worker processes that scan the projects. Uses the CPU count by "
+                                   "default.")
+        parser.add_argument("--rescan", "-r", action = "store_true", default = False,
+                            help = "Ignore the index of previously cleaned project files and scan all of them again.")
+        TraceProfiler.add_arguments(parser)
         args = parser.parse_args()
+        TraceProfiler.enable_from_args(args)
         sln_path = args.slnpath
+        self.__package_ids = frozenset(args.packageids.split(";"))
+        self.__worker_count = args.workers
+        self.__rescan = args.rescan
 
         if sln_path is None:
             self.__exit_with_error(1, "Solution path is not provided for build.", parser.format_help())
 
         self.__dir_path = EasyPath.get_directory(sln_path)
+        if self.__dir_path is None:
+            self.__exit_with_error(1, "Solution path is not a valid file or directory.", parser.format_help())
 
         # Initialize processrun
         self.__process_run = ProcessRunner(self.__logger.silent)
 
 
     def clean(self):
-        exit_code = self.__clean_refs(self.__dir_path)
+        with self.__logger.span("clean refs"):
+            exit_code = self.__clean_refs(self.__dir_path)
         if exit_code != 0:
             self.__exit_with_error(exit_code, "Fody references in projects were not removed successfully.")
 
@@ -46,23 +72,67 @@ class FodyCleaner:
         self.__logger.log_linebreaks(2)
         self.__logger.log(f"Cleaning Fody references...", LogLevel.WARNING)
 
-        packages_path_format = str(dir_path) + "*/*/packages.config"
-        file_paths = EasyPath.glob_cwd(packages_path_format)
-        package_keys = [".//package[@id=\"Costura.Fody\"]", ".//package[@id=\"Fody\"]"]
-        for file_path in file_paths:
-            self.__logger.log(f"Searching for Fody references in {file_path}.")
-            file = ElementTree.parse(file_path)
-            file_root = file.getroot()
-            was_ref_found = False
-            for package in package_keys:
-                elem = file_root.find(package)
-                if elem is not None:
-                    file_root.remove(elem)
-                    was_ref_found = True
-            if was_ref_found:
-                file.write(file_path, encoding = "utf-8", xml_declaration = True)
-                self.__logger.log(f"Cleaned Fody refs in {file_path}.", LogLevel.WARNING)
-        return 0
+        start_time = time.monotonic()
+        self.__logger.log(f"Searching for {sorted(self.__package_ids)} references in "
+                          f"{', '.join(self.project_file_patterns)} files...")
+
+        # The index maps each project file to its size, mtime and content hash when it was last known to be clean.
+        # It is only valid for the same set of package ids.
+        index_file = StateFile(dir_path, self.index_file_name)
+        index = index_file.load()
+        entries = {}
+        if not self.__rescan and index.get("package_ids") == sorted(self.__package_ids):
+            entries = index.get("files", {})
+
+        file_count = 0
+        new_entries = {}
+        pending_paths = []
+        modified_count = 0
+        error_count = 0
+        stat_error_count = 0
+        with ProcessPoolExecutor(max_workers = self.__worker_count) as executor:
+            # Files are handed to the workers as the walk finds them, so cleaning starts before the walk finishes.
+            futures = []
+            file_paths = (str(file_path) for file_pattern in self.project_file_patterns
+                          for file_path in EasyPath.glob(dir_path, file_pattern))
+            for file_path in file_paths:
+                file_count += 1
+                entry = entries.get(file_path)
+                try:
+                    stat = os.stat(file_path)
+                except OSError as error:
+                    # The file vanished or is unreadable; it is left out of the index so the next run retries it.
+                    self.__logger.log(f"Could not stat {file_path}: {error}", LogLevel.ERROR)
+                    error_count += 1
+                    stat_error_count += 1
+                    continue
+                if entry is not None and entry["size"] == stat.st_size and entry["mtime_ns"] == stat.st_mtime_ns:
+                    new_entries[file_path] = entry
+                    continue
+                known_hash = None if entry is None else entry["hash"]
+                pending_paths.append(file_path)
+                futures.append(executor.submit(clean_package_refs, file_path, self.__package_ids, known_hash))
+            for file_path, future in zip(pending_paths, futures):
+                try:
+                    result = future.result()
+                except (ElementTree.ParseError, OSError) as error:
+                    self.__logger.log(f"Could not clean {file_path}: {error}", LogLevel.ERROR)
+                    error_count += 1
+                    continue
+                new_entries[file_path] = {"size": result.size, "mtime_ns": result.mtime_ns, "hash": result.hash,
+                                          "removed_ids": result.removed_ids}
+                if result.removed_ids:
+                    modified_count += 1
+                    self.__logger.log(f"Cleaned Fody refs {result.removed_ids} in {file_path}.", LogLevel.WARNING)
+
+        index_file.save({"package_ids": sorted(self.__package_ids), "files": new_entries})
+
+        indexed_count = file_count - len(pending_paths) - stat_error_count
+        skipped_count = len(pending_paths) - modified_count - (error_count - stat_error_count)
+        self.__logger.log(f"Found {file_count} files: {indexed_count} unchanged since the last run, "
+                          f"{len(pending_paths)} scanned, {modified_count} modified, {skipped_count} skipped, "
+                          f"{error_count} failed. Took {time.monotonic() - start_time:.2f}s.")
+        return 0 if error_count == 0 else 1
 
 
     def __exit_with_error(self, error_code, error_msg, usage_info = None):
@@ -70,9 +140,54 @@ class FodyCleaner:
                           LogLevel.ERROR)
         if usage_info is not None:
             self.__logger.log(usage_info, LogLevel.WARNING)
+        self.__logger.flush()
         exit(error_code)
 
 
+def clean_package_refs(file_path, package_ids, known_hash = None):
+    # Runs in a worker process, so this has to be a picklable module-level function.
+    with open(file_path, "rb") as file:
+        content = file.read()
+    content_hash = hashlib.sha256(content).hexdigest()
+    if content_hash != known_hash:
+        # Keep comments so that rewritten .csproj files only lose the removed references.
+        parser = ElementTree.XMLParser(target = ElementTree.TreeBuilder(insert_comments = True))
+        file_root = ElementTree.fromstring(content, parser)
+        # Check every package against the set in a single pass instead of one find() per id. This covers both
+        # <package id="..."> in packages.config and <PackageReference Include="..."> in SDK-style projects.
+        matches = []
+        for parent in file_root.iter():
+            for elem in parent:
+                if not isinstance(elem.tag, str):
+                    continue
+                tag = elem.tag.rsplit("}", 1)[-1]
+                package_id = elem.get("id") if tag == "package" else elem.get("Include")
+                if tag in ("package", "PackageReference") and package_id in package_ids:
+                    matches.append((parent, elem, package_id))
+
+        # Files without any matches are left untouched on disk.
+        if matches:
+            for parent, elem, package_id in matches:
+                parent.remove(elem)
+            xml_declaration = file_root.tag == "packages" or content.lstrip().startswith(b"<?xml")
+            content = ElementTree.tostring(file_root, encoding = "utf-8", xml_declaration = xml_declaration)
+            with open(file_path, "wb") as file:
+                file.write(content)
+            content_hash = hashlib.sha256(content).hexdigest()
+            stat = os.stat(file_path)
+            return PackageCleanResult([package_id for parent, elem, package_id in matches], stat.st_size,
+                                      stat.st_mtime_ns, content_hash)
+
+    stat = os.stat(file_path)
+    return PackageCleanResult([], stat.st_size, stat.st_mtime_ns, content_hash)
+
+
+PackageCleanResult = collections.namedtuple("PackageCleanResult", ["removed_ids", "size", "mtime_ns", "hash"])
+
+# Without this, rewritten classic .csproj files would get an "ns0:" prefix on every element.
+ElementTree.register_namespace("", "http://schemas.microsoft.com/developer/msbuild/2003")
+
+
 if __name__ == "__main__":
     cleaner = FodyCleaner(False)
     cleaner.clean()
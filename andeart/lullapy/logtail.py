@@ -0,0 +1,54 @@
+import os
+import threading
+
+
+class LogTailer:
+    # Follows a log file that another process is writing, calling line_callback with each complete line as it appears.
+    # The file does not have to exist yet when tailing starts.
+
+    def __init__(self, log_path, line_callback, poll_interval = 0.25):
+        self.__log_path = log_path
+        self.__line_callback = line_callback
+        self.__poll_interval = poll_interval
+        self.__position = 0
+        self.__partial_line = b""
+        self.__stop_event = threading.Event()
+        self.__thread = threading.Thread(target = self.__follow, daemon = True)
+
+
+    def start(self):
+        self.__thread.start()
+
+
+    def stop(self):
+        # Lines written before stop was called are still passed on, including a last line without a line ending.
+        self.__stop_event.set()
+        self.__thread.join()
+        if self.__partial_line:
+            self.__line_callback(self.__partial_line.decode("utf-8", errors = "replace").rstrip("\r"))
+            self.__partial_line = b""
+
+
+    def __follow(self):
+        while not self.__stop_event.wait(self.__poll_interval):
+            self.__read_new_lines()
+        self.__read_new_lines()
+
+
+    def __read_new_lines(self):
+        try:
+            if os.path.getsize(self.__log_path) < self.__position:
+                # The file was truncated or replaced, so start again from its beginning.
+                self.__position = 0
+                self.__partial_line = b""
+            with open(self.__log_path, "rb") as log_file:
+                log_file.seek(self.__position)
+                data = log_file.read()
+                self.__position = log_file.tell()
+        except OSError:
+            return
+
+        lines = (self.__partial_line + data).split(b"\n")
+        self.__partial_line = lines.pop()
+        for line in lines:
+            self.__line_callback(line.decode("utf-8", errors = "replace").rstrip("\r"))
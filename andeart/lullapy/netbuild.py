@@ -1,13 +1,29 @@
 import argparse
+import collections
+import hashlib
 import os
-import platform
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
 
 from andeart.lullapy.easypath import EasyPath
 from andeart.lullapy.processrun import ProcessRunner
 from andeart.lullapy.shyprint import LogLevel, Logger
+from andeart.lullapy.slnparse import SolutionParser
+from andeart.lullapy.statefile import StateFile
+from andeart.lullapy.toolfind import ToolFinder
+from andeart.lullapy.traceprofile import TraceProfiler
 
 
 class NetBuilder:
+    config_names = ["Release", "Debug"]
+    state_file_name = "netbuild-state.json"
+    # Solution-level files that affect every project in the build.
+    shared_input_names = ["Directory.Build.props", "Directory.Build.targets", "NuGet.Config", "nuget.config"]
+    ignored_dir_names = {"bin", "obj"}
+    output_extensions = {".dll", ".exe"}
+
 
     # noinspection SpellCheckingInspection
     def __init__(self, silent = False):
@@ -20,96 +36,342 @@ class NetBuilder:
         # Parse CLI args
         parser = argparse.ArgumentParser(description = "Build VS solution along with project tests.")
         parser.add_argument("--slnpath", "-s", type = str, metavar = "SolutionPath", default = None,
-                            help = "The path to the solution to build.")
-        parser.add_argument("--config", "-c", choices = ["Release", "Debug"], type = str, metavar = "ConfigurationName",
-                            default = "Debug", help = "The ConfigurationName to be used with MSBuild.")
+                            help = "The path to the solution to build. Use a semicolon-separated list to build several "
+                                   "solutions.")
+        parser.add_argument("--config", "-c", type = str, metavar = "ConfigurationName", default = "Debug",
+                            help = f"The ConfigurationName to be used with MSBuild, one of {self.config_names}. Use a "
+                                   f"semicolon-separated list (ex: \"Debug;Release\") to build each solution in "
+                                   f"several configurations.")
+        parser.add_argument("--manifest", "-m", type = str, metavar = "ManifestPath", default = None,
+                            help = "The path to a text file listing builds, one per line, as \"SolutionPath\" or "
+                                   "\"SolutionPath;ConfigurationName[;ConfigurationName...]\". Lines without "
+                                   "configurations use --config. These are built in addition to --slnpath.")
+        parser.add_argument("--matrixjobs", "-x", type = int, metavar = "MatrixJobCount", default = 1,
+                            help = "The maximum number of solution/configuration builds run at once when building "
+                                   "several of them. Builds one at a time by default.")
+        parser.add_argument("--incremental", "-i", action = "store_true", default = False,
+                            help = "Skip MSBuild if the solution, its projects, their source files and the "
+                                   "configuration are unchanged since the last successful build, and its outputs "
+                                   "still exist.")
+        parser.add_argument("--force", "-f", action = "store_true", default = False,
+                            help = "Always run MSBuild, even in incremental mode.")
+        parser.add_argument("--parallel", "-p", action = "store_true", default = False,
+                            help = "Build the solution's projects separately, in dependency order, running independent "
+                                   "projects concurrently. A failed project only stops the projects that depend on it.")
+        parser.add_argument("--jobs", "-j", type = int, metavar = "JobCount", default = None,
+                            help = "The maximum number of projects built at once in parallel mode. Uses the CPU count "
+                                   "by default.")
+        TraceProfiler.add_arguments(parser)
         args = parser.parse_args()
-        self.__sln_path = args.slnpath
-        self.__config_name = args.config
-
-        self.__logger.log(f"Solution path: {self.__sln_path}" + f"\nConfiguration: {self.__config_name}",
-                          LogLevel.WARNING)
-
-        if self.__sln_path is None:
+        TraceProfiler.enable_from_args(args)
+        self.__matrix_job_count = args.matrixjobs
+        self.__incremental = args.incremental
+        self.__force = args.force
+        self.__parallel = args.parallel
+        self.__job_count = args.jobs
+        self.__state_lock = threading.Lock()
+
+        config_names = args.config.split(";")
+        for config_name in config_names:
+            if config_name not in self.config_names:
+                self.__exit_with_error(1, f"Configuration {config_name} is not one of {self.config_names}.",
+                                       parser.format_help())
+
+        # Each build cell is one solution built in one configuration.
+        self.__cells = []
+        if args.slnpath is not None:
+            for sln_path in args.slnpath.split(";"):
+                self.__cells.extend((sln_path, config_name) for config_name in config_names)
+        if args.manifest is not None:
+            if not EasyPath.is_file(args.manifest):
+                self.__exit_with_error(1, "Manifest path is not a valid file.", parser.format_help())
+            manifest_cells = self.__read_manifest(args.manifest, config_names)
+            for sln_path, config_name in manifest_cells:
+                if config_name not in self.config_names:
+                    self.__exit_with_error(1, f"Configuration {config_name} for {sln_path} in the manifest is not one "
+                                              f"of {self.config_names}.", parser.format_help())
+            self.__cells.extend(manifest_cells)
+        self.__cells = list(dict.fromkeys(self.__cells))
+
+        if len(self.__cells) == 1:
+            self.__logger.log(f"Solution path: {self.__cells[0][0]}" + f"\nConfiguration: {self.__cells[0][1]}",
+                              LogLevel.WARNING)
+        else:
+            self.__logger.log(f"Build matrix: {len(self.__cells)} builds\n" +
+                              "\n".join(f"{sln_path} | {config_name}" for sln_path, config_name in self.__cells),
+                              LogLevel.WARNING)
+
+        if not self.__cells:
             self.__exit_with_error(1, "Solution path was not provided for build.", parser.format_help())
 
-        if not EasyPath.is_file(self.__sln_path):
-            self.__exit_with_error(1, "Solution path is not a valid file.", parser.format_help())
+        for sln_path, config_name in self.__cells:
+            if not EasyPath.is_file(sln_path):
+                self.__exit_with_error(1, f"Solution path is not a valid file: {sln_path}", parser.format_help())
 
         # Initialize processrun
-        self.__process_run = ProcessRunner(self.__logger.silent)
-
+        # MSBuild output can be huge, so it is logged as it arrives rather than held in memory.
+        self.__process_run = ProcessRunner(self.__logger.silent, stream = True)
 
-    def build(self):
+        # Initialize toolfind
+        self.__tool_find = ToolFinder(self.__logger.silent)
 
-        result = self.__run_msbuild(self.__sln_path, self.__config_name)
-        if result.status != 0:
-            self.__exit_with_error(result.status, "MSBuild failed to run successfully on solution.")
 
-        self.__logger.log("Build was successful.", LogLevel.SUCCESS)
-
-
-    def __run_msbuild(self, sln_path, config_name):
+    def build(self):
+        # The toolchain is located once and shared by every build cell.
+        with self.__logger.span("locate MSBuild"):
+            msbuild_path = self.__locate_msbuild()
+
+        if len(self.__cells) == 1:
+            result = self.__build_cell(msbuild_path, 0, self.__cells[0])
+            if result.status != 0:
+                self.__exit_with_error(result.status, result.message)
+            self.__logger.log("Build was successful.", LogLevel.SUCCESS)
+            return
+
+        with ThreadPoolExecutor(max_workers = self.__matrix_job_count) as executor:
+            results = list(executor.map(lambda index, cell: self.__build_cell(msbuild_path, index, cell),
+                                        range(len(self.__cells)), self.__cells))
+
+        self.__log_matrix_results(results)
+        failed_count = sum(1 for result in results if result.status != 0)
+        if failed_count > 0:
+            self.__exit_with_error(1, f"{failed_count} of {len(results)} builds failed.")
+
+        self.__logger.log("All builds were successful.", LogLevel.SUCCESS)
+
+
+    def __build_cell(self, msbuild_path, index, cell):
+        # Runs on a worker thread in matrix builds, so a failure only fails this cell rather than the whole matrix.
+        (sln_path, config_name) = cell
+        prefix = "" if len(self.__cells) == 1 else f"[{index + 1}/{len(self.__cells)}] "
+        start_time = time.monotonic()
+        try:
+            with self.__logger.span(f"build {EasyPath.get_absolute_path(sln_path).name} ({config_name})"):
+                (status, message) = self.__build_solution(msbuild_path, sln_path, config_name, prefix)
+        except Exception as e:
+            self.__logger.log(prefix + f"Build of {sln_path} ({config_name}) failed: {e}", LogLevel.ERROR)
+            (status, message) = (1, f"Failed: {e}")
+        return BuildCellResult(sln_path, config_name, status, message, time.monotonic() - start_time)
+
+
+    def __build_solution(self, msbuild_path, sln_path, config_name, prefix):
+        state_file = None
+        fingerprint = None
+        state_key = None
+        if self.__incremental:
+            state_file = StateFile(EasyPath.get_directory(sln_path), self.state_file_name)
+            with self.__logger.span("fingerprint inputs"):
+                fingerprint = self.__get_input_fingerprint(sln_path, config_name)
+            state_key = f"{EasyPath.get_absolute_path(sln_path).name}|{config_name}"
+            rebuild_reason = self.__get_rebuild_reason(state_file.load().get(state_key), fingerprint, config_name)
+            if rebuild_reason is None:
+                self.__logger.log(prefix + f"Skipping build of {sln_path} ({config_name}): inputs are unchanged since "
+                                           f"the last successful build and its outputs still exist.", LogLevel.SUCCESS)
+                return 0, "Skipped: inputs unchanged."
+            self.__logger.log(prefix + f"Rebuilding {sln_path} ({config_name}): {rebuild_reason}",
+                              LogLevel.WARNING)
+
+        if self.__parallel:
+            failed_projects = self.__run_msbuild_graph(msbuild_path, sln_path, config_name, prefix)
+            if failed_projects:
+                return 1, f"MSBuild failed to run successfully on {len(failed_projects)} project(s): " \
+                          f"{', '.join(failed_projects)}"
+        else:
+            result = self.__run_msbuild(msbuild_path, sln_path, config_name, prefix)
+            if result.status != 0:
+                return result.status, "MSBuild failed to run successfully on solution."
+
+        if self.__incremental:
+            # The fingerprint is taken before the build, so any input edited while MSBuild ran triggers a rebuild.
+            outputs = self.__get_outputs(fingerprint["projects"].keys(), config_name)
+            with self.__state_lock:
+                state = state_file.load()
+                state[state_key] = {"fingerprint": fingerprint, "built_at": datetime.now().isoformat(),
+                                    "outputs": outputs}
+                state_file.save(state)
+
+        return 0, "Built."
+
+
+    def __run_msbuild(self, msbuild_path, sln_path, config_name, prefix):
         self.__logger.log_linebreaks(2)
-        self.__logger.log("Building solution...", LogLevel.WARNING)
-        msbuild_path = self.__locate_msbuild()
+        self.__logger.log(prefix + f"Building solution {sln_path} ({config_name})...", LogLevel.WARNING)
         cmd_line = f"{msbuild_path} {sln_path} -p:Configuration={config_name}"
         return self.__process_run.run_line(cmd_line)
 
 
-    def __locate_vs_installation(self):
-        vswhere_path = self.__locate_vs_where("ProgramFiles")
-        if vswhere_path is None:
-            # Try (x86) directory...
-            vswhere_path = self.__locate_vs_where("ProgramFiles(x86)")
-            if vswhere_path is None:
-                return None
-
-        vswhere_cmd = f"{vswhere_path} -latest -requires Microsoft.Component.MSBuild"
-        final_path = None
-
-        result = self.__process_run.run_line(vswhere_cmd)
-        for item in result.output.splitlines():
-            split_item = item.split(":", 1)
-            if split_item[0] == "installationPath":
-                final_path = split_item[1].strip()
-                self.__logger.log(f"VS Installation was found at: {final_path}", LogLevel.SUCCESS)
-                self.__logger.log_linebreaks(2)
-
-        return final_path
-
-    def __locate_vs_where(self, program_files_var):
-        vswhere_sub_path = "/Microsoft Visual Studio/Installer/vswhere.exe"
-        program_files_location = os.environ.get(program_files_var)
-        if program_files_location is None:
-            self.__logger.log(f"No {program_files_location} variable was found in environment.", LogLevel.WARNING)
-            return None
-        vswhere_path = program_files_location + vswhere_sub_path
-        if not EasyPath.is_file(vswhere_path):
-            self.__logger.log(f"No executable found at {vswhere_path}", LogLevel.WARNING)
-            return None
-        return vswhere_path
-
+    def __run_msbuild_graph(self, msbuild_path, sln_path, config_name, prefix):
+        self.__logger.log_linebreaks(2)
+        self.__logger.log(prefix + f"Building projects of {sln_path} ({config_name}) in dependency order...",
+                          LogLevel.WARNING)
+        graph = SolutionParser.get_project_graph(sln_path)
+        (waves, cyclic_projects) = self.__get_build_waves(graph)
+        if cyclic_projects:
+            self.__logger.log(prefix + f"Project dependencies contain a cycle between: {', '.join(cyclic_projects)}",
+                              LogLevel.ERROR)
+            return cyclic_projects
+
+        solution_properties = self.__get_solution_properties(sln_path)
+        failed_projects = []
+        skipped_projects = set()
+        for wave_index, wave in enumerate(waves):
+            # Skip anything that depends on a failed project, directly or through a skipped one.
+            unbuildable_projects = set(failed_projects) | skipped_projects
+            wave_projects = []
+            for project_path in wave:
+                if unbuildable_projects.intersection(graph[project_path]):
+                    self.__logger.log(prefix + f"Skipping {project_path}: a project it depends on was not built.",
+                                      LogLevel.WARNING)
+                    skipped_projects.add(project_path)
+                else:
+                    wave_projects.append(project_path)
+            if not wave_projects:
+                continue
+
+            self.__logger.log(prefix + f"Building wave {wave_index + 1}/{len(waves)}: {len(wave_projects)} "
+                                       f"project(s)...", LogLevel.WARNING)
+            # References were built by earlier waves, so MSBuild must not rebuild them concurrently from here.
+            cmd_lines = [f"{msbuild_path} {project_path} -p:Configuration={config_name} "
+                         f"-p:BuildProjectReferences=false {solution_properties}" for project_path in wave_projects]
+            with self.__logger.span("build wave"):
+                results = self.__process_run.run_many(cmd_lines, max_workers = self.__job_count)
+            for project_path, result in zip(wave_projects, results):
+                if result.status != 0:
+                    self.__logger.log(prefix + f"MSBuild failed on {project_path}.", LogLevel.ERROR)
+                    failed_projects.append(project_path)
+
+        if skipped_projects:
+            self.__logger.log(prefix + f"{len(skipped_projects)} project(s) were skipped because of failed "
+                                       f"dependencies.", LogLevel.ERROR)
+        return failed_projects
+
+
+    @staticmethod
+    def __get_solution_properties(sln_path):
+        # MSBuild only defines these when it builds a solution, so projects built on their own would otherwise see
+        # them undefined, and anything using $(SolutionDir) (output paths, build events) would resolve differently.
+        sln_path = EasyPath.get_absolute_path(sln_path)
+        (sln_name, sln_ext) = os.path.splitext(sln_path.name)
+        sln_dir = os.path.join(str(sln_path.parent), "")
+        return f"-p:SolutionDir={sln_dir} -p:SolutionPath={sln_path} -p:SolutionName={sln_name} " \
+               f"-p:SolutionFileName={sln_path.name} -p:SolutionExt={sln_ext}"
+
+
+    @staticmethod
+    def __get_build_waves(graph):
+        # Each wave holds the projects whose dependencies were all built in earlier waves. Whatever remains when no
+        # further wave can be formed is part of a dependency cycle.
+        remaining = {project_path: set(dependencies) for project_path, dependencies in graph.items()}
+        waves = []
+        while remaining:
+            wave = sorted(project_path for project_path, dependencies in remaining.items()
+                          if not dependencies.intersection(remaining))
+            if not wave:
+                return waves, sorted(remaining)
+            waves.append(wave)
+            for project_path in wave:
+                del remaining[project_path]
+        return waves, []
 
 
     def __locate_msbuild(self):
-        if platform.system() != "Windows":
-            self.__logger.log("Not on Windows- MSBuild is usually available on PATH here.", LogLevel.WARNING)
-            return "msbuild"
-
-        self.__logger.log("On Windows OS. Locating MSBuild via vswhere...")
-        vs_installation_path = self.__locate_vs_installation()
-        if vs_installation_path is None:
-            self.__logger.log("VS Installation was not found.", LogLevel.ERROR)
+        msbuild_path = self.__tool_find.find_msbuild()
+        if msbuild_path is None:
+            self.__exit_with_error(1, "MSBuild could not be located.")
+        return msbuild_path
+
+
+    def __get_input_fingerprint(self, sln_path, config_name):
+        # Absolute paths keep the recorded state valid regardless of the directory the build is started from.
+        sln_path = EasyPath.get_absolute_path(sln_path)
+        sln_dir = EasyPath.get_directory(sln_path)
+        sln_hasher = hashlib.sha256()
+        for input_path in [sln_path] + [EasyPath.combine(sln_dir, name) for name in self.shared_input_names]:
+            if EasyPath.is_file(input_path):
+                with open(input_path, "rb") as input_file:
+                    sln_hasher.update(str(input_path).encode() + b"\0" + input_file.read())
+
+        project_hashes = {}
+        for project in SolutionParser.get_projects(sln_path):
+            project_hashes[str(project.path)] = self.__get_project_hash(project.path)
+        return {"config": config_name, "solution": sln_hasher.hexdigest(), "projects": project_hashes}
+
+
+    def __get_project_hash(self, project_path):
+        if not EasyPath.is_file(project_path):
             return None
+        hasher = hashlib.sha256()
+        with open(project_path, "rb") as project_file:
+            hasher.update(project_file.read())
+
+        # Source files are fingerprinted by their size and mtime only, so unchanged trees are never read.
+        project_dir = EasyPath.get_directory(project_path)
+        for root, dir_names, file_names in os.walk(project_dir):
+            dir_names[:] = sorted(dir_name for dir_name in dir_names
+                                  if dir_name.lower() not in self.ignored_dir_names and not dir_name.startswith("."))
+            for file_name in sorted(file_names):
+                file_path = os.path.join(root, file_name)
+                stat = os.stat(file_path)
+                hasher.update(f"{os.path.relpath(file_path, project_dir)}|{stat.st_size}|{stat.st_mtime_ns}\n"
+                              .encode())
+        return hasher.hexdigest()
+
+
+    def __get_outputs(self, project_paths, config_name):
+        outputs = []
+        for project_path in project_paths:
+            output_dir = EasyPath.combine(EasyPath.combine(EasyPath.get_directory(project_path), "bin"), config_name)
+            for root, dir_names, file_names in os.walk(output_dir):
+                outputs.extend(os.path.join(root, file_name) for file_name in file_names
+                               if os.path.splitext(file_name)[1].lower() in self.output_extensions)
+        return sorted(outputs)
+
+
+    def __get_rebuild_reason(self, last_build, fingerprint, config_name):
+        if self.__force:
+            return "--force was given."
+        if last_build is None:
+            return f"no previous successful {config_name} build was recorded."
+
+        last_fingerprint = last_build["fingerprint"]
+        if last_fingerprint["solution"] != fingerprint["solution"]:
+            return "the solution file or its shared build files changed."
+        if last_fingerprint["projects"].keys() != fingerprint["projects"].keys():
+            return "projects were added to or removed from the solution."
+        changed_projects = [project_path for project_path, project_hash in fingerprint["projects"].items()
+                            if project_hash != last_fingerprint["projects"][project_path]]
+        if changed_projects:
+            return f"inputs changed in {len(changed_projects)} project(s): {', '.join(changed_projects)}"
+        for output_path in last_build["outputs"]:
+            if not EasyPath.is_file(output_path):
+                return f"recorded output {output_path} is missing."
+        return None
 
-        vs_msbuild_pattern = "MSBuild/*/Bin/MSBuild.exe"
-        locations = EasyPath.glob(vs_installation_path, vs_msbuild_pattern)
-        for location in sorted(locations, reverse = True):
-            if EasyPath.is_file(location):
-                return location
 
-        return None
+    @staticmethod
+    def __read_manifest(manifest_path, default_config_names):
+        cells = []
+        with open(manifest_path) as manifest_file:
+            for line in manifest_file:
+                line = line.strip()
+                if not line or line.startswith("#"):
+                    continue
+                parts = [part.strip() for part in line.split(";")]
+                config_names = [part for part in parts[1:] if part] or default_config_names
+                cells.extend((parts[0], config_name) for config_name in config_names)
+        return cells
+
+
+    def __log_matrix_results(self, results):
+        self.__logger.log_linebreaks(2)
+        headers = ("Solution", "Configuration", "Duration", "Result")
+        rows = [(result.sln_path, result.config_name, f"{result.duration:.2f}s", result.message) for result in results]
+        widths = [max(len(row[column]) for row in rows + [headers]) for column in range(len(headers) - 1)]
+        self.__logger.log("  ".join(header.ljust(width) for header, width in zip(headers, widths)) + "  " + headers[-1],
+                          LogLevel.WARNING)
+        for result, row in zip(results, rows):
+            self.__logger.log("  ".join(cell.ljust(width) for cell, width in zip(row, widths)) + "  " + row[-1],
+                              LogLevel.SUCCESS if result.status == 0 else LogLevel.ERROR)
 
 
     def __exit_with_error(self, error_code, error_msg, usage_info = None):
@@ -117,9 +379,14 @@ class NetBuilder:
                           LogLevel.ERROR)
         if usage_info is not None:
             self.__logger.log(usage_info, LogLevel.WARNING)
+        self.__logger.flush()
         exit(error_code)
 
 
+BuildCellResult = collections.namedtuple("BuildCellResult",
+                                         ["sln_path", "config_name", "status", "message", "duration"])
+
+
 if __name__ == "__main__":
     builder = NetBuilder(False)
     builder.build()
@@ -1,11 +1,23 @@
 import argparse
+import hashlib
+import os
+import sys
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from shutil import copyfile
 
 from andeart.lullapy.easypath import EasyPath
+from andeart.lullapy.filewatch import FileWatcher
 from andeart.lullapy.shyprint import LogLevel, Logger
+from andeart.lullapy.statefile import StateFile
+from andeart.lullapy.traceprofile import TraceProfiler
 
 
 class NetCopy:
+    manifest_file_name = "netcopy-manifest.json"
+    link_modes = ["copy", "hardlink", "symlink", "reflink"]
+    # The FICLONE ioctl request number from linux/fs.h.
+    ficlone_request = 0x40049409
 
     # noinspection SpellCheckingInspection
     def __init__(self, silent = False):
@@ -15,6 +27,9 @@ class NetCopy:
         self.__logger = Logger(self)
         self.__logger.silent = silent
 
+        # Source files are checked here and again before copying, so each path is only statted once per run.
+        EasyPath.enable_stat_cache()
+
         # Parse CLI args
         parser = argparse.ArgumentParser(description = "Copy built assembly to target directories. Best used as a "
                                                        "post-build event on the VS project.")
@@ -37,13 +52,46 @@ class NetCopy:
                             help = "Specify if a sub-directory with the assembly name should be created in the target "
                                    "directories. Use this as a flag, i.e. simply add -c or --createsubdir without "
                                    "additional args")
+        parser.add_argument("--workers", "-w", type = int, metavar = "WorkerCount", default = None,
+                            help = "The number of target directories copied to at once. Uses Python's default thread "
+                                   "pool size by default.")
+        parser.add_argument("--incremental", "-i", action = "store_true", default = False,
+                            help = "Only replace target files whose contents differ from the source files, so that "
+                                   "unchanged files keep their mtimes (and Unity does not re-import them). Files are "
+                                   "compared by size and content hash, and the hashes are cached in the assembly "
+                                   "directory.")
+        parser.add_argument("--linkmode", "-l", choices = self.link_modes, type = str, metavar = "LinkMode",
+                            default = "copy",
+                            help = "How files are placed in the target directories: copy, hardlink, symlink or reflink "
+                                   "(a copy-on-write clone, or an in-kernel copy where clones are not supported). "
+                                   "Falls back to a plain copy where the chosen mode fails, ex: across filesystems. "
+                                   "Note that hardlinked and symlinked targets change whenever the build output is "
+                                   "modified in place.")
+        parser.add_argument("--watch", action = "store_true", default = False,
+                            help = "Keep running after copying, and copy again (incrementally) whenever the built "
+                                   "assembly files change. A burst of writes is only copied once the files have "
+                                   "stopped changing. Stop with Ctrl+C.")
+        parser.add_argument("--settletime", "-s", type = float, metavar = "SettleSeconds", default = 1.0,
+                            help = "In watch mode, how long the built assembly files must stay unchanged before they "
+                                   "are copied.")
 
+        TraceProfiler.add_arguments(parser)
         args = parser.parse_args()
+        TraceProfiler.enable_from_args(args)
         self.__as_name = args.asname
         self.__as_dir = args.asdir
         self.__as_types = args.astypes.split(";")
         self.__target_dirs = args.targetdirs
         self.__create_subdir = args.createsubdir
+        self.__worker_count = args.workers
+        self.__incremental = args.incremental
+        self.__link_mode = args.linkmode
+        self.__watch = args.watch
+        self.__settle_time = args.settletime
+        if self.__watch and not self.__incremental:
+            self.__logger.log("Watch mode always copies incrementally.", LogLevel.WARNING)
+            self.__incremental = True
+        self.__manifest_lock = threading.Lock()
 
         self.__logger.log(
             f"Assembly name: {self.__as_name}" + f"\nAssembly directory: {self.__as_dir}" + f"\nAssembly extensions: "
@@ -75,43 +123,274 @@ class NetCopy:
 
 
     def copy_files(self):
-        for target_dir in self.__target_dirs:
-            self.__logger.log_linebreaks(1)
-            if self.__create_subdir:
-                target_dir = EasyPath.combine(target_dir, self.__as_name)
-            self.__logger.log(f"Covering target directory: {target_dir}...")
-
-            if not EasyPath.is_dir(target_dir):
-                self.__logger.log("Directory does not exist. Creating new directory.")
-                target_dir.mkdir(parents = True)
-
-            # Remove any existing files in the target directory.
-            for as_type in self.__as_types:
-                self.__logger.log_linebreaks(1)
-                # Delete existing files. Add * to the extension glob to delete helper files (ex: .meta files)
-                file_pattern = EasyPath.get_file_path(target_dir, self.__as_name, as_type + "*")
-                file_paths = EasyPath.glob_cwd(file_pattern)
-                for file_path in sorted(file_paths):
-                    if EasyPath.is_file(file_path):
-                        self.__logger.log(f"Deleting {file_path}", LogLevel.WARNING)
-                        file_path.unlink()
-
-                # Copy new files
-                source_file_path = EasyPath.get_file_path(self.__as_dir, self.__as_name, as_type)
-                if not EasyPath.is_file(source_file_path):
-                    self.__exit_with_error(1, f"Could not find expected source file at: {source_file_path}")
-                target_file_path = EasyPath.get_file_path(target_dir, self.__as_name, as_type)
-                self.__logger.log(f"Copying {source_file_path} to {target_file_path}...")
-                copyfile(source_file_path, target_file_path)
+        if self.__watch:
+            self.__watch_and_copy_files()
+            return
+
+        # Source files are checked up front, since a missing one would fail every target the same way.
+        missing_file_path = self.__get_missing_source_file_path()
+        if missing_file_path is not None:
+            self.__exit_with_error(1, f"Could not find expected source file at: {missing_file_path}")
+
+        failures = self.__copy_to_targets()
+        if failures:
+            self.__exit_with_error(1, f"Could not copy to {len(failures)} of {len(self.__target_dirs)} target "
+                                      f"directories.")
 
         self.__logger.log("Successfully copied all targeted files.", LogLevel.SUCCESS)
 
 
+    def __watch_and_copy_files(self):
+        file_names = [f"{self.__as_name}.{as_type}" for as_type in self.__as_types]
+        watcher = FileWatcher(self.__as_dir, file_names)
+        self.__logger.log(f"Watching {self.__as_dir} for changes to {', '.join(file_names)} "
+                          f"({'inotify' if watcher.uses_inotify else 'polling'}). Stop with Ctrl+C.", LogLevel.WARNING)
+        try:
+            changed_names = None
+            while True:
+                if changed_names is not None:
+                    self.__logger.log_linebreaks(1)
+                    self.__logger.log(f"Changed: {', '.join(sorted(changed_names))}", LogLevel.WARNING)
+                # Failures only skip this round of copies, since the next build may well fix them.
+                EasyPath.invalidate()
+                missing_file_path = self.__get_missing_source_file_path()
+                try:
+                    failures = None if missing_file_path is not None else self.__copy_to_targets()
+                except OSError as e:
+                    # Source files can still be replaced by the build while they are hashed.
+                    self.__logger.log(f"Could not read source files: {e}", LogLevel.ERROR)
+                    failures = True
+                if missing_file_path is not None:
+                    self.__logger.log(f"Could not find expected source file at: {missing_file_path}. Waiting for "
+                                      "the next change...", LogLevel.ERROR)
+                elif failures:
+                    self.__logger.log("Could not copy to all target directories. Waiting for the next change...",
+                                      LogLevel.ERROR)
+                else:
+                    self.__logger.log("Successfully copied all targeted files. Waiting for the next change...",
+                                      LogLevel.SUCCESS)
+                changed_names = watcher.wait_for_changes(self.__settle_time)
+        except KeyboardInterrupt:
+            self.__logger.log("Stopped watching.", LogLevel.WARNING)
+        finally:
+            watcher.close()
+
+
+    def __get_missing_source_file_path(self):
+        for as_type in self.__as_types:
+            source_file_path = EasyPath.get_file_path(self.__as_dir, self.__as_name, as_type)
+            if not EasyPath.is_file(source_file_path):
+                return source_file_path
+        return None
+
+
+    def __copy_to_targets(self):
+        # Returns the (target directory, error) pair of each target that could not be copied to.
+        source_file_paths = {as_type: EasyPath.get_file_path(self.__as_dir, self.__as_name, as_type)
+                             for as_type in self.__as_types}
+
+        # The manifest maps each source and target file to its size, mtime and content hash when it was last hashed or
+        # written, so unchanged files are not hashed again.
+        manifest_file = StateFile(self.__as_dir, self.manifest_file_name)
+        if self.__incremental:
+            manifest = manifest_file.load()
+            self.__known_states = dict(manifest.get("sources", {}), **manifest.get("targets", {}))
+            with self.__logger.span("hash sources"):
+                self.__source_states = {as_type: self.__get_file_state(source_file_path)
+                                        for as_type, source_file_path in source_file_paths.items()}
+            self.__target_states = {}
+
+        self.__logger.log_linebreaks(1)
+        with ThreadPoolExecutor(max_workers = self.__worker_count) as executor:
+            errors = list(executor.map(self.__copy_to_target, range(len(self.__target_dirs)), self.__target_dirs))
+
+        if self.__incremental:
+            sources = {str(EasyPath.get_absolute_path(source_file_paths[as_type])): state
+                       for as_type, state in self.__source_states.items()}
+            manifest_file.save({"sources": sources, "targets": self.__target_states})
+
+        failures = [(target_dir, error) for target_dir, error in zip(self.__target_dirs, errors) if error is not None]
+        if failures:
+            self.__logger.log_linebreaks(1)
+            for target_dir, error in failures:
+                self.__logger.log(f"Could not copy to {target_dir}: {error}", LogLevel.ERROR)
+        return failures
+
+
+    def __copy_to_target(self, index, target_dir):
+        # Runs on a worker thread, so failures are returned to be reported together rather than exiting here.
+        prefix = f"[{index + 1}/{len(self.__target_dirs)}] "
+        # Once the link mode fails for a target, the rest of its files are copied without trying it again.
+        link_mode = self.__link_mode
+        used_modes = set()
+        with self.__logger.span("copy to target"):
+            try:
+                if self.__create_subdir:
+                    target_dir = EasyPath.combine(target_dir, self.__as_name)
+                self.__logger.log(prefix + f"Covering target directory: {target_dir}...")
+
+                if not EasyPath.is_dir(target_dir):
+                    self.__logger.log(prefix + "Directory does not exist. Creating new directory.")
+                    target_dir.mkdir(parents = True, exist_ok = True)
+                    EasyPath.invalidate(target_dir)
+
+                as_types = self.__as_types
+                if self.__incremental:
+                    as_types = []
+                    for as_type in self.__as_types:
+                        target_file_path = EasyPath.get_file_path(target_dir, self.__as_name, as_type)
+                        if self.__is_target_current(as_type, target_file_path):
+                            self.__logger.log(prefix + f"Skipping unchanged {target_file_path}")
+                        else:
+                            as_types.append(as_type)
+
+                # Remove any existing files in the target directory.
+                stale_file_names = self.__get_stale_file_names(target_dir, as_types)
+                if stale_file_names:
+                    self.__logger.log(prefix + f"Deleting {len(stale_file_names)} files in {target_dir}: "
+                                               f"{', '.join(stale_file_names)}", LogLevel.WARNING)
+                    for file_name in stale_file_names:
+                        stale_file_path = EasyPath.combine(target_dir, file_name)
+                        os.remove(stale_file_path)
+                        EasyPath.invalidate(stale_file_path)
+
+                for as_type in as_types:
+                    source_file_path = EasyPath.get_file_path(self.__as_dir, self.__as_name, as_type)
+                    target_file_path = EasyPath.get_file_path(target_dir, self.__as_name, as_type)
+
+                    # Copy new files
+                    self.__logger.log(prefix + f"Copying {source_file_path} to {target_file_path}...")
+                    try:
+                        if self.__incremental:
+                            used_mode = self.__replace_atomically(source_file_path, target_file_path, link_mode,
+                                                                  prefix)
+                            self.__set_target_state(target_file_path, self.__source_states[as_type]["hash"])
+                        else:
+                            used_mode = self.__place_file(source_file_path, target_file_path, link_mode, prefix)
+                    finally:
+                        # The stat cache is on for the whole run, so it must not keep the target's old state.
+                        EasyPath.invalidate(target_file_path)
+                    used_modes.add(used_mode)
+                    if used_mode == "copy":
+                        link_mode = "copy"
+            except OSError as e:
+                self.__logger.log(prefix + f"Failed: {e}", LogLevel.ERROR)
+                return e
+        if used_modes:
+            self.__logger.log(prefix + f"Placed files in {target_dir} with: {', '.join(sorted(used_modes))}",
+                              LogLevel.SUCCESS if used_modes == {self.__link_mode} else LogLevel.WARNING)
+        return None
+
+
+    def __get_stale_file_names(self, target_dir, as_types):
+        # Lists the target directory once and matches every extension in memory, rather than globbing per extension,
+        # since each listing is a round trip on network shares. Extensions match with anything after them, to also
+        # delete helper files (ex: .meta files).
+        prefixes = tuple(os.path.normcase(f"{self.__as_name}.{as_type}") for as_type in as_types)
+        if not prefixes:
+            return []
+        # In incremental mode, the target files themselves are replaced atomically rather than deleted first.
+        kept_names = {os.path.normcase(f"{self.__as_name}.{as_type}") for as_type in as_types} \
+            if self.__incremental else set()
+        with os.scandir(target_dir) as entries:
+            return sorted(entry.name for entry in entries if not entry.is_dir() and
+                          os.path.normcase(entry.name).startswith(prefixes) and
+                          os.path.normcase(entry.name) not in kept_names)
+
+
+    def __is_target_current(self, as_type, target_file_path):
+        source_state = self.__source_states[as_type]
+        try:
+            stat = os.stat(target_file_path)
+        except FileNotFoundError:
+            return False
+        if stat.st_size != source_state["size"]:
+            return False
+        target_state = self.__get_file_state(target_file_path)
+        with self.__manifest_lock:
+            self.__target_states[str(EasyPath.get_absolute_path(target_file_path))] = target_state
+        return target_state["hash"] == source_state["hash"]
+
+
+    def __set_target_state(self, target_file_path, content_hash):
+        stat = os.stat(target_file_path)
+        with self.__manifest_lock:
+            self.__target_states[str(EasyPath.get_absolute_path(target_file_path))] = {
+                "size": stat.st_size, "mtime_ns": stat.st_mtime_ns, "hash": content_hash}
+
+
+    def __get_file_state(self, file_path):
+        # Reuses the manifest's hash while the file's size and mtime are unchanged.
+        stat = os.stat(file_path)
+        known_state = self.__known_states.get(str(EasyPath.get_absolute_path(file_path)))
+        if known_state is not None and known_state["size"] == stat.st_size and \
+                known_state["mtime_ns"] == stat.st_mtime_ns:
+            return known_state
+        hasher = hashlib.sha256()
+        with open(file_path, "rb") as file:
+            for chunk in iter(lambda: file.read(1024 * 1024), b""):
+                hasher.update(chunk)
+        return {"size": stat.st_size, "mtime_ns": stat.st_mtime_ns, "hash": hasher.hexdigest()}
+
+
+    def __replace_atomically(self, source_file_path, target_file_path, link_mode, prefix):
+        # Place next to the target and rename over it, so the target never holds a partially copied file.
+        temp_path = f"{target_file_path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        try:
+            used_mode = self.__place_file(source_file_path, temp_path, link_mode, prefix)
+            os.replace(temp_path, target_file_path)
+        finally:
+            if os.path.lexists(temp_path):
+                os.remove(temp_path)
+        return used_mode
+
+
+    def __place_file(self, source_file_path, target_file_path, link_mode, prefix):
+        # Returns the mode that was actually used, which is "copy_file_range" where reflink fell back to an in-kernel
+        # copy, and "copy" where the link mode failed.
+        if link_mode == "copy":
+            copyfile(source_file_path, target_file_path)
+            return "copy"
+        try:
+            if link_mode == "hardlink":
+                os.link(source_file_path, target_file_path)
+                return "hardlink"
+            if link_mode == "symlink":
+                os.symlink(os.path.abspath(source_file_path), target_file_path)
+                return "symlink"
+            return self.__reflink(source_file_path, target_file_path)
+        except OSError as e:
+            self.__logger.log(prefix + f"Could not {link_mode} {target_file_path} ({e}). Copying instead.",
+                              LogLevel.WARNING)
+            if os.path.lexists(target_file_path):
+                os.remove(target_file_path)
+            copyfile(source_file_path, target_file_path)
+            return "copy"
+
+
+    def __reflink(self, source_file_path, target_file_path):
+        if sys.platform != "linux":
+            raise OSError("reflinks are only supported on Linux")
+        import fcntl
+        with open(source_file_path, "rb") as source_file, open(target_file_path, "wb") as target_file:
+            try:
+                fcntl.ioctl(target_file.fileno(), self.ficlone_request, source_file.fileno())
+                return "reflink"
+            except OSError:
+                pass
+            # copy_file_range still copies within the kernel, and shares extents on some filesystems (ex: NFS 4.2
+            # server-side copies).
+            while os.copy_file_range(source_file.fileno(), target_file.fileno(), 1024 * 1024 * 1024) > 0:
+                pass
+            return "copy_file_range"
+
+
     def __exit_with_error(self, error_code, error_msg, usage_info = None):
         self.__logger.log(f"ERROR! Exiting...\nError code: {str(error_code)}\nError message: {error_msg}",
                           LogLevel.ERROR)
         if usage_info is not None:
             self.__logger.log(usage_info, LogLevel.WARNING)
+        self.__logger.flush()
         exit(error_code)
 
 
@@ -1,11 +1,27 @@
 import argparse
+import hashlib
+import os
+from datetime import datetime
 
 from andeart.lullapy.easypath import EasyPath
+from andeart.lullapy.packstore import PackageStore
 from andeart.lullapy.processrun import ProcessRunner
 from andeart.lullapy.shyprint import LogLevel, Logger
+from andeart.lullapy.slnparse import SolutionParser
+from andeart.lullapy.statefile import StateFile
+from andeart.lullapy.toolfind import ToolFinder
+from andeart.lullapy.traceprofile import TraceProfiler
 
 
 class NetRestore:
+    state_file_name = "netrestore-state.json"
+    packages_dir_name = "packages"
+    # Solution-level files that affect what gets restored.
+    shared_manifest_names = ["nuget.config", "NuGet.Config", "NuGet.config", "Directory.Packages.props",
+                             "Directory.Build.props"]
+    # Per-project dependency manifests, next to each project file.
+    project_manifest_names = ["packages.config", "packages.lock.json"]
+
 
     # noinspection SpellCheckingInspection
     def __init__(self, silent = False):
@@ -19,8 +35,23 @@ class NetRestore:
         parser = argparse.ArgumentParser(description = "Restore dependencies in VS solution.")
         parser.add_argument("--slnpath", "-s", type = str, metavar = "SolutionPath", default = None,
                             help = "The path to the solution to restore.")
+        parser.add_argument("--incremental", "-i", action = "store_true", default = False,
+                            help = "Skip nuget restore if no dependency manifest (project files, packages.config, "
+                                   "nuget.config, ...) changed since the last successful restore, and the restored "
+                                   "packages are still in place.")
+        parser.add_argument("--force", "-f", action = "store_true", default = False,
+                            help = "Always run nuget restore, even in incremental mode.")
+        parser.add_argument("--packagestore", "-p", type = str, metavar = "PackageStorePath", default = None,
+                            help = "The path to a local content-addressed package store. In incremental mode, a "
+                                   "missing packages folder is populated from it with copies when it holds a "
+                                   "restore of the same manifests. Restored packages are added to it.")
+        TraceProfiler.add_arguments(parser)
         args = parser.parse_args()
+        TraceProfiler.enable_from_args(args)
         self.__sln_path = args.slnpath
+        self.__incremental = args.incremental
+        self.__force = args.force
+        self.__package_store = None if args.packagestore is None else PackageStore(args.packagestore)
 
         self.__logger.log(f"Solution path: {self.__sln_path}", LogLevel.WARNING)
 
@@ -30,22 +61,120 @@ class NetRestore:
         if not EasyPath.is_file(self.__sln_path):
             self.__exit_with_error(1, "Solution path is not a valid file.", parser.format_help())
 
+        self.__sln_dir = EasyPath.get_directory(EasyPath.get_absolute_path(self.__sln_path))
+
         # Initialize processrun
         self.__process_run = ProcessRunner(self.__logger.silent)
 
+        # Initialize toolfind
+        self.__tool_find = ToolFinder(self.__logger.silent)
+
 
     def restore(self):
-        result = self.__run_nuget_restore(self.__sln_path)
+        packages_dir = EasyPath.combine(self.__sln_dir, self.packages_dir_name)
+        state_file = StateFile(self.__sln_dir, self.state_file_name)
+        manifest_hash = None
+        if self.__incremental:
+            with self.__logger.span("hash manifests"):
+                manifest_hash = self.__get_manifest_hash(self.__sln_path)
+            if self.__try_skip_restore(state_file, manifest_hash, packages_dir):
+                self.__logger.log("NuGet packages for solution were restored successfully.", LogLevel.SUCCESS)
+                return
+
+        with self.__logger.span("restore"):
+            result = self.__run_nuget_restore(self.__sln_path)
         if result.status != 0:
             self.__exit_with_error(result.status, "NuGet packages for solution were not restored correctly.")
 
+        if self.__incremental:
+            restored_paths = self.__get_restored_paths(packages_dir)
+            state_file.save({"manifest_hash": manifest_hash, "restored_at": datetime.now().isoformat(),
+                             "restored_paths": restored_paths})
+            if self.__package_store is not None and EasyPath.is_dir(packages_dir):
+                with self.__logger.span("save to package store"):
+                    file_count = self.__package_store.save_snapshot(manifest_hash, packages_dir, restored_paths)
+                self.__logger.log(f"Stored {file_count} package files in the package store.")
+
         self.__logger.log("NuGet packages for solution were restored successfully.", LogLevel.SUCCESS)
 
 
+    def __try_skip_restore(self, state_file, manifest_hash, packages_dir):
+        if self.__force:
+            self.__logger.log("Restoring: --force was given.", LogLevel.WARNING)
+            return False
+
+        state = state_file.load()
+        if state.get("manifest_hash") == manifest_hash:
+            missing_path = self.__get_missing_path(state["restored_paths"])
+            if missing_path is None:
+                self.__logger.log("Skipping nuget restore: dependency manifests are unchanged since the last "
+                                  "successful restore and the restored packages are in place.", LogLevel.SUCCESS)
+                return True
+            self.__logger.log(f"Previously restored {missing_path} is missing.", LogLevel.WARNING)
+        else:
+            self.__logger.log("No previous restore of the current dependency manifests was recorded.",
+                              LogLevel.WARNING)
+
+        if self.__package_store is not None and self.__package_store.has_snapshot(manifest_hash):
+            self.__logger.log("Populating packages folder from the package store...")
+            with self.__logger.span("load from package store"):
+                restored_paths = self.__package_store.load_snapshot(manifest_hash, packages_dir)
+            # The store only holds the packages folder, so nuget still has to run if PackageReference restore outputs
+            # (obj/project.assets.json) are missing.
+            if restored_paths is not None and self.__get_missing_path(restored_paths) is None:
+                state_file.save({"manifest_hash": manifest_hash, "restored_at": datetime.now().isoformat(),
+                                 "restored_paths": restored_paths})
+                self.__logger.log("Skipping nuget restore: packages folder was populated from the package store.",
+                                  LogLevel.SUCCESS)
+                return True
+
+        self.__logger.log("Restoring: packages are out of date.", LogLevel.WARNING)
+        return False
+
+
     def __run_nuget_restore(self, sln_path):
         self.__logger.log_linebreaks(2)
         self.__logger.log("Running nuget restore...", LogLevel.WARNING)
-        return self.__process_run.run_line(f"nuget restore {sln_path}")
+        nuget_path = self.__tool_find.find_nuget()
+        return self.__process_run.run_line(f"{nuget_path} restore {sln_path}")
+
+
+    def __get_manifest_hash(self, sln_path):
+        manifest_paths = [EasyPath.get_absolute_path(sln_path)]
+        manifest_paths.extend(EasyPath.combine(self.__sln_dir, name) for name in self.shared_manifest_names)
+        for project in SolutionParser.get_projects(sln_path):
+            manifest_paths.append(project.path)
+            project_dir = os.path.dirname(project.path)
+            manifest_paths.extend(EasyPath.combine(project_dir, name) for name in self.project_manifest_names)
+
+        hasher = hashlib.sha256()
+        for manifest_path in sorted(set(str(manifest_path) for manifest_path in manifest_paths)):
+            if EasyPath.is_file(manifest_path):
+                with open(manifest_path, "rb") as manifest_file:
+                    hasher.update(os.path.relpath(manifest_path, self.__sln_dir).encode() + b"\0")
+                    hasher.update(manifest_file.read())
+        return hasher.hexdigest()
+
+
+    def __get_restored_paths(self, packages_dir):
+        # Paths, relative to the solution directory, that must still exist for a previous restore to be intact: each
+        # package in the packages folder and each project's PackageReference restore output.
+        restored_paths = []
+        if EasyPath.is_dir(packages_dir):
+            restored_paths.extend(os.path.join(self.packages_dir_name, name)
+                                  for name in sorted(os.listdir(packages_dir)))
+        for project in SolutionParser.get_projects(self.__sln_path):
+            assets_path = os.path.join(os.path.dirname(project.path), "obj", "project.assets.json")
+            if EasyPath.is_file(assets_path):
+                restored_paths.append(os.path.relpath(assets_path, self.__sln_dir))
+        return restored_paths
+
+
+    def __get_missing_path(self, restored_paths):
+        for restored_path in restored_paths:
+            if not os.path.exists(EasyPath.combine(self.__sln_dir, restored_path)):
+                return restored_path
+        return None
 
 
     def __exit_with_error(self, error_code, error_msg, usage_info = None):
@@ -53,6 +182,7 @@ class NetRestore:
                           LogLevel.ERROR)
         if usage_info is not None:
             self.__logger.log(usage_info, LogLevel.WARNING)
+        self.__logger.flush()
         exit(error_code)
 
 
@@ -1,11 +1,27 @@
 import argparse
+import heapq
 
 from andeart.lullapy.easypath import EasyPath
 from andeart.lullapy.processrun import ProcessRunner
 from andeart.lullapy.shyprint import LogLevel, Logger
+from andeart.lullapy.testhistory import TestHistory
+from andeart.lullapy.testresults import TestResults
+from andeart.lullapy.toolfind import ToolFinder
+from andeart.lullapy.traceprofile import TraceProfiler
 
 
 class NetTester:
+    vstest_args = "/Framework:.NETFramework,Version=v4.7.1 /InIsolation"
+    results_name = "results.trx"
+    failed_first_results_name = "failed-first.trx"
+    merged_results_name = "merged.trx"
+    test_list_name = "tests.txt"
+    # Windows limits command lines to 32767 characters. Test lists that would not fit in one vstest command line are
+    # split across several vstest runs.
+    max_cmd_line_length = 30000
+    # The number of most recent runs in the test history that durations and recent failures are taken from.
+    history_run_count = 10
+
 
     # noinspection SpellCheckingInspection
     def __init__(self, silent = False):
@@ -19,8 +35,25 @@ class NetTester:
         parser = argparse.ArgumentParser(description = "Run tests for VS solution.")
         parser.add_argument("--testspath", "-t", type = str, metavar = "TestsPath", default = None,
                             help = "The path to the tests assembly.")
+        parser.add_argument("--shards", "-n", type = int, metavar = "ShardCount", default = 1,
+                            help = "The number of parallel vstest processes to split the tests across. Shards are "
+                                   "balanced by the test durations in the test history, when available.")
+        parser.add_argument("--failedfirst", "-F", action = "store_true", default = False,
+                            help = "Run the tests that failed in recent runs in their own vstest process before the "
+                                   "other tests, so that their failures are reported sooner.")
+        parser.add_argument("--resultsdir", "-r", type = str, metavar = "ResultsDirectory", default = "TestResults",
+                            help = "The directory that the .trx results (per-shard and merged, in sharded runs) are "
+                                   "written to.")
+        parser.add_argument("--slowest", "-k", type = int, metavar = "SlowestCount", default = 10,
+                            help = "The number of slowest tests to list in the results summary.")
+        TraceProfiler.add_arguments(parser)
         args = parser.parse_args()
+        TraceProfiler.enable_from_args(args)
         self.__tests_path = args.testspath
+        self.__shard_count = args.shards
+        self.__failed_first = args.failedfirst
+        self.__results_dir = args.resultsdir
+        self.__slowest_count = args.slowest
 
         self.__logger.log(f"Tests path: {self.__tests_path}", LogLevel.WARNING)
 
@@ -31,13 +64,24 @@ class NetTester:
             self.__exit_with_error(1, "Tests assembly is not a valid file.", parser.format_help())
 
         # Initialize processrun
-        self.__process_run = ProcessRunner(self.__logger.silent)
+        # vstest output can be huge, so it is logged as it arrives rather than held in memory.
+        self.__process_run = ProcessRunner(self.__logger.silent, stream = True)
+
+        # Initialize toolfind
+        self.__tool_find = ToolFinder(self.__logger.silent)
+
+        # Every run is recorded in the test history next to the tests assembly, under the assembly's name.
+        self.__history = TestHistory(TestHistory.get_default_path(EasyPath.get_directory(self.__tests_path)))
+        self.__history_suite = EasyPath.get_absolute_path(self.__tests_path).name
 
 
     def run_tests(self):
-        result = self.__run_vstest(self.__tests_path)
-        if result.status != 0:
-            self.__exit_with_error(result.status, "Tests were not run successfully.")
+        if self.__shard_count > 1 or self.__failed_first:
+            status = self.__run_sharded_vstest(self.__tests_path, self.__shard_count)
+        else:
+            status = self.__run_vstest(self.__tests_path).status
+        if status != 0:
+            self.__exit_with_error(status, "Tests were not run successfully.")
 
         self.__logger.log("Tests were run successfully.", LogLevel.SUCCESS)
 
@@ -45,8 +89,185 @@ class NetTester:
     def __run_vstest(self, tests_path):
         self.__logger.log_linebreaks(2)
         self.__logger.log("Running .Net Framework tests...", LogLevel.WARNING)
-        cmd_line = f"dotnet vstest {tests_path} /Framework:.NETFramework,Version=v4.7.1 /InIsolation /logger:trx"
-        return self.__process_run.run_line(cmd_line)
+        with self.__logger.span("locate dotnet"):
+            dotnet_path = self.__tool_find.find_dotnet()
+        results_dir = EasyPath.get_absolute_path(self.__results_dir)
+        results_path = EasyPath.combine(results_dir, self.results_name)
+        if EasyPath.is_file(results_path):
+            results_path.unlink()
+        with self.__logger.span("run tests"):
+            result = self.__process_run.run_line(self.__get_vstest_cmd_line(dotnet_path, tests_path, results_path))
+        if EasyPath.is_file(results_path):
+            self.__log_results(results_path)
+            self.__record_results(results_path)
+        return result
+
+
+    def __run_sharded_vstest(self, tests_path, shard_count):
+        self.__logger.log_linebreaks(2)
+        self.__logger.log(f"Running .Net Framework tests in {shard_count} shard(s)...", LogLevel.WARNING)
+        with self.__logger.span("locate dotnet"):
+            dotnet_path = self.__tool_find.find_dotnet()
+        with self.__logger.span("list tests"):
+            test_names = self.__list_tests(dotnet_path, tests_path)
+        if not test_names:
+            self.__logger.log("No tests could be listed for sharding. Running all tests in one process.",
+                              LogLevel.WARNING)
+            return self.__run_vstest(tests_path).status
+
+        results_dir = EasyPath.get_absolute_path(self.__results_dir)
+        results_paths = []
+        statuses = []
+        if self.__failed_first:
+            recent_failures = {self.__get_filter_name(test_name) for test_name
+                               in self.__history.get_recent_failures(self.__history_suite, self.history_run_count)}
+            failed_test_names = [test_name for test_name in test_names if test_name in recent_failures]
+            if failed_test_names:
+                self.__logger.log(f"Running {len(failed_test_names)} recently failed tests first...", LogLevel.WARNING)
+                batches = self.__split_to_fit(dotnet_path, tests_path,
+                                              EasyPath.combine(results_dir, self.failed_first_results_name),
+                                              failed_test_names)
+                with self.__logger.span("run recently failed tests"):
+                    (batch_statuses, batch_results_paths) = self.__run_batches(dotnet_path, tests_path, batches,
+                                                                               shard_count)
+                statuses.extend(batch_statuses)
+                for results_path in batch_results_paths:
+                    self.__log_results(results_path)
+                results_paths.extend(batch_results_paths)
+                test_names = [test_name for test_name in test_names if test_name not in recent_failures]
+
+        if test_names:
+            shards = self.__split_into_shards(test_names, self.__get_filter_durations(), shard_count)
+            batches = []
+            for index, shard in enumerate(shards):
+                batches.extend(self.__split_to_fit(dotnet_path, tests_path,
+                                                   EasyPath.combine(results_dir, f"shard-{index + 1}.trx"), shard))
+            if len(batches) > len(shards):
+                self.__logger.log(f"Split {len(shards)} shard(s) into {len(batches)} vstest runs to keep command lines "
+                                  f"under {self.max_cmd_line_length} characters.", LogLevel.WARNING)
+
+            # Note that vstest matches /Tests values as substrings of test names, so a test whose name contains
+            # another test's name may run in more than one shard. Merging the results only keeps its first result.
+            with self.__logger.span("run tests"):
+                (batch_statuses, batch_results_paths) = self.__run_batches(dotnet_path, tests_path, batches,
+                                                                           len(shards))
+            statuses.extend(batch_statuses)
+            results_paths.extend(batch_results_paths)
+
+        if results_paths:
+            merged_results_path = EasyPath.combine(results_dir, self.merged_results_name)
+            with self.__logger.span("merge results"):
+                counters = TestResults.merge_trx(results_paths, merged_results_path)
+            self.__logger.log(f"Merged {len(results_paths)} results files into {merged_results_path}: "
+                              f"{counters.get('total', 0)} total, {counters.get('passed', 0)} passed, "
+                              f"{counters.get('failed', 0)} failed.",
+                              LogLevel.SUCCESS if counters.get("failed", 0) == 0 else LogLevel.ERROR)
+            self.__log_results(merged_results_path)
+            self.__record_results(merged_results_path)
+
+        failed_statuses = [status for status in statuses if status != 0]
+        return failed_statuses[0] if failed_statuses else 0
+
+
+    def __split_to_fit(self, dotnet_path, tests_path, results_path, test_names):
+        # Returns (test names, results path) batches whose command lines fit in max_cmd_line_length. When the tests
+        # have to be split, each batch gets its own results file next to results_path.
+        base_length = len(self.__get_vstest_cmd_line(dotnet_path, tests_path, results_path, []))
+        batches = [[]]
+        cmd_line_length = base_length
+        for test_name in test_names:
+            if batches[-1] and cmd_line_length + len(test_name) + 1 > self.max_cmd_line_length:
+                batches.append([])
+                cmd_line_length = base_length
+            batches[-1].append(test_name)
+            cmd_line_length += len(test_name) + 1
+        if len(batches) == 1:
+            return [(batches[0], results_path)]
+        return [(batch, results_path.with_name(f"{results_path.stem}-{index + 1}{results_path.suffix}"))
+                for index, batch in enumerate(batches)]
+
+
+    def __run_batches(self, dotnet_path, tests_path, batches, max_workers):
+        # Returns the status of each vstest run, and the results files that were written.
+        for test_names, results_path in batches:
+            if EasyPath.is_file(results_path):
+                results_path.unlink()
+        cmd_lines = [self.__get_vstest_cmd_line(dotnet_path, tests_path, results_path, test_names)
+                     for test_names, results_path in batches]
+        results = self.__process_run.run_many(cmd_lines, max_workers = max_workers)
+        return ([result.status for result in results],
+                [results_path for test_names, results_path in batches if EasyPath.is_file(results_path)])
+
+
+    def __get_vstest_cmd_line(self, dotnet_path, tests_path, results_path, test_names = None):
+        cmd_line = f"{dotnet_path} vstest {tests_path} {self.vstest_args} " \
+                   f"/logger:trx;LogFileName={results_path.name} /ResultsDirectory:{results_path.parent}"
+        if test_names is not None:
+            cmd_line += f" /Tests:{','.join(test_names)}"
+        return cmd_line
+
+
+    def __log_results(self, results_path):
+        with self.__logger.span("summarize results"):
+            summary = TestResults.summarize(TestResults.iter_test_cases(results_path), self.__slowest_count)
+        TestResults.log_summary(self.__logger, summary)
+
+
+    def __record_results(self, results_path):
+        with self.__logger.span("record test history"):
+            count = self.__history.record_run(self.__history_suite, TestResults.iter_test_cases(results_path))
+        self.__logger.log(f"Recorded {count} test results in the test history at {self.__history.db_path}.")
+
+
+    def __list_tests(self, dotnet_path, tests_path):
+        # Stream mode only keeps the tail of the output, so the full listing is spilled to a file and read from there.
+        results_dir = EasyPath.get_absolute_path(self.__results_dir)
+        results_dir.mkdir(parents = True, exist_ok = True)
+        list_path = EasyPath.combine(results_dir, self.test_list_name)
+        result = self.__process_run.run_line(f"{dotnet_path} vstest {tests_path} {self.vstest_args} --ListTests",
+                                             spill_path = list_path)
+        if result.status != 0:
+            return []
+        test_names = []
+        is_listing = False
+        with open(list_path, encoding = "utf-8") as list_file:
+            for line in list_file:
+                line = line.rstrip("\n")
+                if "The following Tests are available" in line:
+                    is_listing = True
+                elif is_listing and line[:1].isspace() and line.strip():
+                    test_names.append(self.__get_filter_name(line.strip()))
+        return list(dict.fromkeys(test_names))
+
+
+    @staticmethod
+    def __get_filter_name(test_name):
+        # Parameterised test names like "Adds(1,2)" cannot be passed through the comma-separated /Tests filter, so all
+        # of their cases are filtered by the shared name before the parameters.
+        return test_name.split("(", 1)[0]
+
+
+    def __get_filter_durations(self):
+        filter_durations = {}
+        for test_name, duration in self.__history.get_durations(self.__history_suite, self.history_run_count).items():
+            filter_name = self.__get_filter_name(test_name)
+            filter_durations[filter_name] = filter_durations.get(filter_name, 0.0) + duration
+        return filter_durations
+
+
+    @staticmethod
+    def __split_into_shards(test_names, durations, shard_count):
+        # Greedily hands the longest remaining test to the shard with the least total duration so far. Tests without
+        # a recorded duration are assumed to take the average duration.
+        known_durations = [durations[test_name] for test_name in test_names if test_name in durations]
+        default_duration = sum(known_durations) / len(known_durations) if known_durations else 1.0
+        shards = [[] for _ in range(shard_count)]
+        shard_totals = [(0.0, index) for index in range(shard_count)]
+        for test_name in sorted(test_names, key = lambda name: durations.get(name, default_duration), reverse = True):
+            (total, index) = heapq.heappop(shard_totals)
+            shards[index].append(test_name)
+            heapq.heappush(shard_totals, (total + durations.get(test_name, default_duration), index))
+        return [shard for shard in shards if shard]
 
 
     def __exit_with_error(self, error_code, error_msg, usage_info = None):
@@ -54,6 +275,7 @@ class NetTester:
                           LogLevel.ERROR)
         if usage_info is not None:
             self.__logger.log(usage_info, LogLevel.WARNING)
+        self.__logger.flush()
         exit(error_code)
 
 
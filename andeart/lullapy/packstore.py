@@ -0,0 +1,117 @@
+import hashlib
+import json
+import os
+import shutil
+import stat
+import sys
+
+from andeart.lullapy.easypath import EasyPath
+
+
+class PackageStore:
+    # Files are stored once by content hash under objects/, and each snapshot lists the files of one restored packages
+    # folder. Objects are read-only copies, never links to a packages folder, so that changes to a restored package
+    # cannot reach the store. Packages folders are populated with writable copies (reflinks where the filesystem
+    # supports them) rather than hardlinks, since a hardlink would share the object's inode: its read-only bit would
+    # block deleting the packages folder on Windows, and a privileged in-place write would still corrupt the store.
+
+    # The FICLONE ioctl request number from linux/fs.h.
+    ficlone_request = 0x40049409
+
+
+    def __init__(self, store_dir):
+        self.__objects_dir = EasyPath.combine(store_dir, "objects")
+        self.__snapshots_dir = EasyPath.combine(store_dir, "snapshots")
+
+
+    def has_snapshot(self, key):
+        return EasyPath.is_file(self.__get_snapshot_path(key))
+
+
+    def save_snapshot(self, key, packages_dir, extra = None):
+        files = {}
+        for root, dir_names, file_names in os.walk(packages_dir):
+            for file_name in file_names:
+                file_path = os.path.join(root, file_name)
+                content_hash = self.__get_file_hash(file_path)
+                object_path = self.__get_object_path(content_hash)
+                if not EasyPath.is_file(object_path):
+                    object_path.parent.mkdir(parents = True, exist_ok = True)
+                    self.__store_atomically(file_path, object_path)
+                files[os.path.relpath(file_path, packages_dir)] = content_hash
+
+        snapshot_path = self.__get_snapshot_path(key)
+        snapshot_path.parent.mkdir(parents = True, exist_ok = True)
+        temp_path = snapshot_path.with_name(f"{snapshot_path.name}.{os.getpid()}.tmp")
+        with open(temp_path, "w", encoding = "utf-8") as snapshot_file:
+            json.dump({"files": files, "extra": extra}, snapshot_file)
+        os.replace(temp_path, snapshot_path)
+        return len(files)
+
+
+    def load_snapshot(self, key, packages_dir):
+        # Returns the snapshot's extra data once packages_dir holds every file of the snapshot, or None if the snapshot
+        # is missing or incomplete. Files that already exist in packages_dir are left as they are.
+        try:
+            with open(self.__get_snapshot_path(key), encoding = "utf-8") as snapshot_file:
+                snapshot = json.load(snapshot_file)
+        except (OSError, ValueError):
+            return None
+
+        files = snapshot["files"]
+        if not all(EasyPath.is_file(self.__get_object_path(content_hash)) for content_hash in files.values()):
+            return None
+        for relative_path, content_hash in files.items():
+            target_path = EasyPath.combine(packages_dir, relative_path)
+            if EasyPath.is_file(target_path):
+                continue
+            target_path.parent.mkdir(parents = True, exist_ok = True)
+            self.__place_atomically(self.__get_object_path(content_hash), target_path)
+        return snapshot["extra"]
+
+
+    def __get_object_path(self, content_hash):
+        return EasyPath.combine(EasyPath.combine(self.__objects_dir, content_hash[:2]), content_hash)
+
+
+    def __get_snapshot_path(self, key):
+        return EasyPath.combine(self.__snapshots_dir, f"{key}.json")
+
+
+    @staticmethod
+    def __store_atomically(source_path, object_path):
+        temp_path = f"{object_path}.{os.getpid()}.tmp"
+        shutil.copy2(source_path, temp_path)
+        os.chmod(temp_path, stat.S_IMODE(os.stat(temp_path).st_mode) & ~(stat.S_IWUSR | stat.S_IWGRP | stat.S_IWOTH))
+        os.replace(temp_path, object_path)
+
+
+    @staticmethod
+    def __place_atomically(source_path, target_path):
+        temp_path = f"{target_path}.{os.getpid()}.tmp"
+        try:
+            PackageStore.__reflink(source_path, temp_path)
+        except OSError:
+            # Reflinks need Linux and a filesystem that supports them (ex: Btrfs, XFS), so fall back to a real copy.
+            shutil.copyfile(source_path, temp_path)
+        shutil.copystat(source_path, temp_path)
+        os.chmod(temp_path, stat.S_IMODE(os.stat(temp_path).st_mode) | stat.S_IWUSR)
+        os.replace(temp_path, target_path)
+
+
+    @staticmethod
+    def __reflink(source_path, target_path):
+        if sys.platform != "linux":
+            raise OSError("reflinks are only supported on Linux")
+        import fcntl
+        with open(source_path, "rb") as source_file, open(target_path, "wb") as target_file:
+            fcntl.ioctl(target_file.fileno(), PackageStore.ficlone_request, source_file.fileno())
+
+
+    @staticmethod
+    def __get_file_hash(file_path):
+        hasher = hashlib.sha256()
+        with open(file_path, "rb") as file:
+            for chunk in iter(lambda: file.read(1024 * 1024), b""):
+                hasher.update(chunk)
+        return hasher.hexdigest()
@@ -2,6 +2,7 @@ from argparse import ArgumentParser
 
 from andeart.lullapy.easypath import EasyPath
 from andeart.lullapy.shyprint import LogLevel, Logger
+from andeart.lullapy.traceprofile import TraceProfiler
 
 
 class PlainExist:
@@ -13,6 +14,9 @@ class PlainExist:
         self.__logger = Logger(self)
         self.__logger.silent = silent
 
+        # The same path may be listed more than once, so each one is only statted once.
+        EasyPath.enable_stat_cache()
+
         # Parse CLI args
         parser = ArgumentParser(description = "A simple check to see if files or directories exist.")
         parser.add_argument("--files", "-f", type = str, metavar = "FilePaths", default = None,
@@ -21,7 +25,9 @@ class PlainExist:
         parser.add_argument("--dirs", "-d", type = str, metavar = "DirectoryPaths", default = None,
                             help = "A semicolon-separated list of paths to the directories to check. Use at least one "
                                    "of this or -f for files.")
+        TraceProfiler.add_arguments(parser)
         args = parser.parse_args()
+        TraceProfiler.enable_from_args(args)
         self.__file_paths = args.files
         self.__dir_paths = args.dirs
 
@@ -37,8 +43,10 @@ class PlainExist:
 
 
     def verify(self):
-        self.__verify_files()
-        self.__verify_dirs()
+        with self.__logger.span("verify files"):
+            self.__verify_files()
+        with self.__logger.span("verify directories"):
+            self.__verify_dirs()
         self.__logger.log("All files and directories were successfully verified.", LogLevel.SUCCESS)
 
 
@@ -67,6 +75,7 @@ class PlainExist:
                           LogLevel.ERROR)
         if usage_info is not None:
             self.__logger.log(usage_info, LogLevel.WARNING)
+        self.__logger.flush()
         exit(error_code)
 
 
@@ -1,32 +1,269 @@
 import collections
+import json
+import os
+import queue
 import shlex
 import subprocess
+import sys
+import textwrap
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
 
-from andeart.lullapy.shyprint import Logger
+from andeart.lullapy.shyprint import LogLevel, Logger
+from andeart.lullapy.traceprofile import TraceProfiler
 
 
 class ProcessRunner:
 
-    def __init__(self, silent = False):
-        self.__logger = Logger(self)
-        self.__logger.silent = silent
+    metrics_path_env_var = "LULLAPY_PROCESS_METRICS"
+    # In stream mode, the most lines that are read ahead of logging. Once the logger falls this far behind, the pipe
+    # readers block, and so does the child process once its pipes fill, so memory stays bounded.
+    stream_queue_size = 1024
+    # The status of run_many jobs whose command could not be started (ex: a missing executable), as shells report it.
+    start_failure_status = 127
+
+
+    def __init__(self, silent = False, stream = False, tail_lines = 1000, metrics_path = None):
+        self.__logger = Logger.get_logger("ProcessRunner", silent)
+        # In stream mode, output is logged line-by-line as it arrives and only the last tail_lines lines are kept.
+        self.__stream = stream
+        self.__tail_lines = tail_lines
+        self.__live_processes = set()
+        # The live processes of each run_many batch, by the batch's cancel event, so fail-fast only kills its own.
+        self.__batch_processes = {}
+        self.__live_lock = threading.Lock()
+        # If set, one JSON record of resource usage is appended to this file per command.
+        self.__metrics_path = metrics_path or os.environ.get(self.metrics_path_env_var)
+        self.__metrics_lock = threading.Lock()
         self.__logger.log("ProcessRunner initialised.")
 
 
-    def run_line(self, cmd_line):        
-        self.__logger.log("Running command: " + cmd_line)
+    def run_line(self, cmd_line, spill_path = None, timeout = None):
+        return self.__run_line(cmd_line, spill_path, timeout, "", None)
+
+
+    def run_args(self, args, spill_path = None, timeout = None):
+        return self.__run_args(args, spill_path, timeout, "", None)
+
+
+    def run_many(self, cmd_lines, max_workers = None, timeout = None, fail_fast = False):
+        cmd_lines = list(cmd_lines)
+        if max_workers is None:
+            max_workers = os.cpu_count() or 1
+        self.__logger.log(f"Running {len(cmd_lines)} commands with up to {max_workers} in parallel.")
+
+        cancel_event = threading.Event()
+        with self.__live_lock:
+            self.__batch_processes[cancel_event] = set()
+
+        def run_job(index):
+            prefix = f"[{index + 1}/{len(cmd_lines)}] "
+            if cancel_event.is_set():
+                self.__logger.log(prefix + "Cancelled before start: " + cmd_lines[index], LogLevel.WARNING)
+                return SubprocessOutputStatus("", None, cancelled = True)
+            try:
+                result = self.__run_line(cmd_lines[index], None, timeout, prefix, cancel_event)
+            except OSError as e:
+                # One job that cannot start must not fail the whole batch, so it gets a failed result of its own.
+                self.__logger.log(prefix + f"Could not start command: {e}", LogLevel.ERROR)
+                result = SubprocessOutputStatus(str(e), self.start_failure_status)
+            if result.status == 0:
+                return result
+            # Any job that fails after cancellation was requested was killed by it, not failed on its own.
+            if cancel_event.is_set():
+                return result._replace(cancelled = True)
+            if fail_fast:
+                self.__logger.log(prefix + "Failed. Cancelling remaining commands...", LogLevel.ERROR)
+                cancel_event.set()
+                self.__terminate_batch(cancel_event)
+            return result
+
+        try:
+            with ThreadPoolExecutor(max_workers = max_workers) as executor:
+                results = list(executor.map(run_job, range(len(cmd_lines))))
+        finally:
+            with self.__live_lock:
+                del self.__batch_processes[cancel_event]
+        return results
+
+
+    def terminate_all(self):
+        with self.__live_lock:
+            live_processes = list(self.__live_processes)
+        for process in live_processes:
+            process.kill()
+
+
+    def __terminate_batch(self, cancel_event):
+        with self.__live_lock:
+            batch_processes = list(self.__batch_processes[cancel_event])
+        for process in batch_processes:
+            process.kill()
+
+
+    def __run_line(self, cmd_line, spill_path, timeout, prefix, cancel_event):
+        self.__logger.log(prefix + "Running command: " + cmd_line)
         args = shlex.split(cmd_line, posix=False)
-        return self.run_args(args)
+        return self.__run_args(args, spill_path, timeout, prefix, cancel_event)
 
 
-    def run_args(self, args):
-        process = subprocess.Popen(args, stdout = subprocess.PIPE, shell = False)
-        (output, error) = process.communicate()
-        return_code = process.wait()
-        output = str(output.decode("utf-8"))
-        self.__logger.log("Command output:\n" + output + "\n" + "Command exit-status/return-code: " + str(return_code))
-        result = SubprocessOutputStatus(output, return_code)
+    def __run_args(self, args, spill_path, timeout, prefix, cancel_event):
+        started_at = datetime.now()
+        start_time = time.perf_counter()
+        stderr = subprocess.PIPE if self.__stream else None
+        process = subprocess.Popen(args, stdout = subprocess.PIPE, stderr = stderr, shell = False)
+        with self.__live_lock:
+            self.__live_processes.add(process)
+            if cancel_event is not None:
+                self.__batch_processes[cancel_event].add(process)
+            # Cancellation may have been requested between this job's start and its registration.
+            if cancel_event is not None and cancel_event.is_set():
+                process.kill()
+
+        timed_out = threading.Event()
+        timer = None
+        if timeout is not None:
+            timer = threading.Timer(timeout, self.__kill_timed_out, args = (process, timed_out))
+            timer.daemon = True
+            timer.start()
+
+        try:
+            if self.__stream:
+                (output, return_code, rusage) = self.__collect_streamed(process, spill_path, prefix)
+            else:
+                (output, return_code, rusage) = self.__collect(process, spill_path, prefix)
+        finally:
+            if timer is not None:
+                timer.cancel()
+            with self.__live_lock:
+                self.__live_processes.discard(process)
+                if cancel_event is not None:
+                    self.__batch_processes[cancel_event].discard(process)
+
+        usage = self.__get_usage(time.perf_counter() - start_time, rusage)
+        TraceProfiler.add_process(args, process.pid, start_time, usage.wall_time, return_code, usage)
+        self.__logger.log(prefix + "Command resource usage: " + self.__format_usage(usage))
+        if timed_out.is_set():
+            self.__logger.log(prefix + f"Command timed out after {timeout} seconds and was killed.", LogLevel.ERROR)
+        result = SubprocessOutputStatus(output, return_code, spill_path, timed_out.is_set(), usage = usage)
+        if self.__metrics_path is not None:
+            self.__write_metrics(args, started_at, result)
         return result
 
 
-SubprocessOutputStatus = collections.namedtuple("SubprocessOutputStatus", ["output", "status"])
+    def __collect(self, process, spill_path, prefix):
+        # Only stdout is piped here, so it can be read to the end before waiting without risking a deadlock.
+        with process.stdout:
+            output = process.stdout.read()
+        (return_code, rusage) = self.__wait(process)
+        output = str(output.decode("utf-8"))
+        if spill_path is not None:
+            with open(spill_path, "w", encoding = "utf-8") as spill_file:
+                spill_file.write(output)
+        self.__logger.log_lazy(lambda: prefix + "Command output:\n" + textwrap.indent(output, prefix) + "\n" + prefix +
+                               "Command exit-status/return-code: " + str(return_code))
+        return output, return_code, rusage
+
+
+    def __collect_streamed(self, process, spill_path, prefix):
+        # Both pipes are drained on their own threads so one cannot fill up and block the child process while the
+        # other is being read.
+        lines = queue.Queue(maxsize = self.stream_queue_size)
+        readers = [threading.Thread(target = self.__read_pipe, args = (process.stdout, LogLevel.INFO, lines),
+                                    daemon = True),
+                   threading.Thread(target = self.__read_pipe, args = (process.stderr, LogLevel.WARNING, lines),
+                                    daemon = True)]
+        for reader in readers:
+            reader.start()
+
+        tail = collections.deque(maxlen = self.__tail_lines)
+        spill_file = None if spill_path is None else open(spill_path, "w", encoding = "utf-8")
+        try:
+            open_pipes = len(readers)
+            while open_pipes > 0:
+                (line, log_level) = lines.get()
+                if line is None:
+                    open_pipes -= 1
+                    continue
+                if self.__logger.is_enabled_for(log_level):
+                    self.__logger.log(prefix + line, log_level)
+                tail.append(line)
+                if spill_file is not None:
+                    spill_file.write(line + "\n")
+        finally:
+            if spill_file is not None:
+                spill_file.close()
+
+        (return_code, rusage) = self.__wait(process)
+        self.__logger.log(prefix + "Command exit-status/return-code: " + str(return_code))
+        return "\n".join(tail), return_code, rusage
+
+
+    @staticmethod
+    def __read_pipe(pipe, log_level, lines):
+        with pipe:
+            for raw_line in iter(pipe.readline, b""):
+                lines.put((raw_line.decode("utf-8", errors = "replace").rstrip("\r\n"), log_level))
+        # A None line marks this pipe as closed.
+        lines.put((None, log_level))
+
+
+    @staticmethod
+    def __kill_timed_out(process, timed_out):
+        timed_out.set()
+        process.kill()
+
+
+    @staticmethod
+    def __wait(process):
+        # wait4 reaps the child and reports its CPU time and peak RSS, including those of any descendants it waited
+        # for. It is only available on POSIX, so elsewhere only wall time is measured.
+        if not hasattr(os, "wait4"):
+            return process.wait(), None
+        try:
+            (pid, wait_status, rusage) = os.wait4(process.pid, 0)
+        except ChildProcessError:
+            # Popen already reaped the child (ex: while it was being killed), so its usage is gone.
+            return process.wait(), None
+        process.returncode = os.waitstatus_to_exitcode(wait_status)
+        return process.returncode, rusage
+
+
+    @staticmethod
+    def __get_usage(wall_time, rusage):
+        if rusage is None:
+            return ProcessUsage(wall_time)
+        # ru_maxrss is in kilobytes on Linux but in bytes on macOS.
+        peak_rss_kb = rusage.ru_maxrss // 1024 if sys.platform == "darwin" else rusage.ru_maxrss
+        return ProcessUsage(wall_time, rusage.ru_utime, rusage.ru_stime, peak_rss_kb)
+
+
+    @staticmethod
+    def __format_usage(usage):
+        if usage.user_time is None:
+            return f"wall {usage.wall_time:.2f}s"
+        return (f"wall {usage.wall_time:.2f}s, user {usage.user_time:.2f}s, system {usage.system_time:.2f}s, "
+                f"peak RSS {usage.peak_rss_kb} KB")
+
+
+    def __write_metrics(self, args, started_at, result):
+        record = {"started_at": started_at.isoformat(), "command": subprocess.list2cmdline(args),
+                  "status": result.status, "timed_out": result.timed_out}
+        record.update(result.usage._asdict())
+        with self.__metrics_lock:
+            with open(self.__metrics_path, "a", encoding = "utf-8") as metrics_file:
+                metrics_file.write(json.dumps(record) + "\n")
+
+
+# In stream mode, output only holds the tail of the command output. The full output is in spill_path, if one was given.
+# Commands that run_many never started, or killed because of fail-fast, have cancelled set (and a None status if never
+# started).
+SubprocessOutputStatus = collections.namedtuple("SubprocessOutputStatus",
+                                                ["output", "status", "spill_path", "timed_out", "cancelled", "usage"],
+                                                defaults = [None, False, False, None])
+
+# Times are in seconds. CPU times and peak RSS are None where the platform does not report them.
+ProcessUsage = collections.namedtuple("ProcessUsage", ["wall_time", "user_time", "system_time", "peak_rss_kb"],
+                                      defaults = [None, None, None])
@@ -1,8 +1,20 @@
+import atexit
+import collections
+import contextlib
+import json
+import os
 import platform
+import queue
+import sys
+import threading
+import time
+from datetime import datetime
 from enum import Enum
 
 from colorama import Fore, Style, init
 
+from andeart.lullapy.traceprofile import TraceProfiler
+
 
 class LogLevel(Enum):
     INFO = 1
@@ -12,42 +24,186 @@ class LogLevel(Enum):
 
 
 class Logger:
+    async_env_var = "LULLAPY_ASYNC_LOG"
+    # The minimum level of messages that are logged, ex: "WARNING".
+    level_env_var = "LULLAPY_LOG_LEVEL"
+    # The path of a JSON-lines file that every message and span is also written to.
+    event_log_env_var = "LULLAPY_EVENT_LOG"
     __style_map = {LogLevel.INFO: ""}
+    # Serialises prints from concurrent ProcessRunner jobs so their lines never interleave.
+    __print_lock = threading.Lock()
+    # Shared by every Logger, so messages from different Loggers keep their order.
+    __async_writer = None
+    # colorama and the style map are set up once per process, by whichever Logger is created first.
+    __init_lock = threading.Lock()
+    __is_initialised = False
+    __default_level = LogLevel.INFO
+    # Shared Loggers, by owner name and silence.
+    __registry = {}
+    __event_sink = None
+    # Every finished span as (name, duration), for the timing summary. The summary is logged at exit by the Logger
+    # that finished the first span.
+    __spans = []
+    __spans_lock = threading.Lock()
 
 
     def __init__(self, owner = None):
-        init()
+        Logger.__init_once()
         self.silent = False
+        self.level = Logger.__default_level
+        self.owner_name = owner if isinstance(owner, str) or owner is None else type(owner).__name__
         self.log(f"Logger initialised. Owner: {str(owner)}")
-        # Use different colours for Windows because it renders ANSI escape codes differently.
-        # More info at: # https://en.wikipedia.org/wiki/ANSI_escape_code#Colors
-        if platform.system() == "Windows":
-            self.__style_map[LogLevel.WARNING] = Fore.LIGHTYELLOW_EX + Style.BRIGHT
-            self.__style_map[LogLevel.ERROR] = Fore.LIGHTRED_EX + Style.BRIGHT
-            self.__style_map[LogLevel.SUCCESS] = Fore.LIGHTGREEN_EX + Style.BRIGHT
-        else:
-            self.__style_map[LogLevel.WARNING] = Fore.YELLOW + Style.BRIGHT
-            self.__style_map[LogLevel.ERROR] = Fore.RED + Style.BRIGHT
-            self.__style_map[LogLevel.SUCCESS] = Fore.GREEN + Style.BRIGHT
+
+
+    @staticmethod
+    def get_logger(owner_name, silent = False):
+        # Returns the process-wide Logger for owner_name, so helpers that are created often (ex: ProcessRunner) share
+        # one rather than each creating their own.
+        with Logger.__init_lock:
+            logger = Logger.__registry.get((owner_name, silent))
+        if logger is None:
+            logger = Logger(owner_name)
+            logger.silent = silent
+            with Logger.__init_lock:
+                logger = Logger.__registry.setdefault((owner_name, silent), logger)
+        return logger
+
+
+    @staticmethod
+    def __init_once():
+        with Logger.__init_lock:
+            if Logger.__is_initialised:
+                return
+            init()
+            # Use different colours for Windows because it renders ANSI escape codes differently.
+            # More info at: # https://en.wikipedia.org/wiki/ANSI_escape_code#Colors
+            if platform.system() == "Windows":
+                Logger.__style_map[LogLevel.WARNING] = Fore.LIGHTYELLOW_EX + Style.BRIGHT
+                Logger.__style_map[LogLevel.ERROR] = Fore.LIGHTRED_EX + Style.BRIGHT
+                Logger.__style_map[LogLevel.SUCCESS] = Fore.LIGHTGREEN_EX + Style.BRIGHT
+            else:
+                Logger.__style_map[LogLevel.WARNING] = Fore.YELLOW + Style.BRIGHT
+                Logger.__style_map[LogLevel.ERROR] = Fore.RED + Style.BRIGHT
+                Logger.__style_map[LogLevel.SUCCESS] = Fore.GREEN + Style.BRIGHT
+            Logger.__default_level = LogLevel.__members__.get(os.environ.get(Logger.level_env_var, "").upper(),
+                                                              LogLevel.INFO)
+            Logger.__is_initialised = True
+        if os.environ.get(Logger.async_env_var):
+            Logger.enable_async()
+        if os.environ.get(Logger.event_log_env_var):
+            Logger.set_event_sink(os.environ[Logger.event_log_env_var])
+        TraceProfiler.enable_from_env()
+
+
+    @staticmethod
+    def set_event_sink(event_log_path):
+        # Also writes every message (whether or not the Logger is silent) and span, as one JSON object per line.
+        with Logger.__init_lock:
+            Logger.__event_sink = JsonLinesSink(event_log_path)
+
+
+    @staticmethod
+    def enable_async(flush_size = 256, flush_interval = 0.05):
+        # Hands console writes to a background thread that writes them in batches, once flush_size messages are waiting
+        # or the oldest has waited flush_interval seconds. Also enabled by setting the LULLAPY_ASYNC_LOG env var.
+        with Logger.__print_lock:
+            if Logger.__async_writer is None:
+                Logger.__async_writer = AsyncLogWriter(flush_size, flush_interval)
+                atexit.register(Logger.flush)
+
+
+    @staticmethod
+    def flush():
+        # Blocks until every message logged so far has been written.
+        if Logger.__async_writer is not None:
+            Logger.__async_writer.flush()
+
+
+    def is_enabled_for(self, log_level):
+        # SUCCESS ranks above ERROR, so run results are still logged when only errors are.
+        return not self.silent and log_level.value >= self.level.value
 
 
     def log(self, msg, log_level = LogLevel.INFO):
-        if not self.silent:
-            print(self.__style_map[log_level] + msg + Style.RESET_ALL)
+        if self.is_enabled_for(log_level):
+            self.__write(self.__style_map[log_level] + msg + Style.RESET_ALL + "\n")
+        self.__write_event(log_level, msg)
+
+
+    def log_lazy(self, msg_factory, log_level = LogLevel.INFO):
+        # msg_factory is only called if the message will be logged, so expensive messages (ex: megabytes of command
+        # output) are never built for nothing.
+        is_enabled = self.is_enabled_for(log_level)
+        if not is_enabled and (Logger.__event_sink is None or log_level.value < self.level.value):
+            return
+        msg = msg_factory()
+        if is_enabled:
+            self.__write(self.__style_map[log_level] + msg + Style.RESET_ALL + "\n")
+        self.__write_event(log_level, msg)
 
 
     def log_override_silence(self, msg, log_level = LogLevel.INFO, overridden_silence = False):
         if not overridden_silence:
-            print(self.__style_map[log_level] + msg + Style.RESET_ALL)
+            self.__write(self.__style_map[log_level] + msg + Style.RESET_ALL + "\n")
+        self.__write_event(log_level, msg)
+
+
+    @contextlib.contextmanager
+    def span(self, name):
+        # Times the code in the with-block as one phase of the run, ex: "restore". Spans with the same name (ex: one
+        # per target directory) are added up in the timing summary.
+        start_time = time.time()
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            duration = time.perf_counter() - start
+            with Logger.__spans_lock:
+                if not Logger.__spans:
+                    atexit.register(self.log_timing_summary)
+                Logger.__spans.append((name, duration))
+            TraceProfiler.add_span(name, start, duration, self.owner_name)
+            if Logger.__event_sink is not None:
+                Logger.__event_sink.write({"time": datetime.fromtimestamp(start_time + duration).isoformat(),
+                                           "event": "span", "owner": self.owner_name, "name": name,
+                                           "start": datetime.fromtimestamp(start_time).isoformat(),
+                                           "duration": duration})
+
+
+    def log_timing_summary(self):
+        with Logger.__spans_lock:
+            spans = list(Logger.__spans)
+        if not spans:
+            return
+        totals = collections.OrderedDict()
+        for (name, duration) in spans:
+            (count, total, longest) = totals.get(name, (0, 0.0, 0.0))
+            totals[name] = (count + 1, total + duration, max(longest, duration))
+        self.log_linebreaks(1)
+        self.log("Timing summary:", LogLevel.WARNING)
+        for name, (count, total, longest) in totals.items():
+            self.log(f"{total:10.3f}s  {name}" + ("" if count == 1 else f" ({count}x, longest {longest:.3f}s)"))
 
 
     def log_linebreaks(self, count = 1):
-        if self.silent:
+        if not self.is_enabled_for(LogLevel.INFO):
             return None
-        i = 0
-        while i < count:
-            print()
-            i += 1
+        self.__write("\n" * count)
+
+
+    def __write_event(self, log_level, msg):
+        if Logger.__event_sink is not None and log_level.value >= self.level.value:
+            Logger.__event_sink.write({"time": datetime.now().isoformat(), "event": "log", "level": log_level.name,
+                                       "owner": self.owner_name, "message": msg})
+
+
+    @staticmethod
+    def __write(text):
+        if Logger.__async_writer is not None:
+            Logger.__async_writer.write(text)
+            return
+        with Logger.__print_lock:
+            sys.stdout.write(text)
 
 
     def debug_log_all_styles(self):
@@ -73,6 +229,71 @@ class Logger:
             print(self.__style_map[log_level] + str(log_level) + Style.RESET_ALL)
 
 
+class JsonLinesSink:
+
+    def __init__(self, path):
+        # Line-buffered, so each event is appended as one whole line even when several tools share the file.
+        self.__file = open(path, "a", encoding = "utf-8", buffering = 1)
+        self.__lock = threading.Lock()
+
+
+    def write(self, event):
+        line = json.dumps(event) + "\n"
+        with self.__lock:
+            self.__file.write(line)
+
+
+class AsyncLogWriter:
+
+    def __init__(self, flush_size, flush_interval):
+        self.__flush_size = flush_size
+        self.__flush_interval = flush_interval
+        self.__queue = queue.SimpleQueue()
+        self.__thread = threading.Thread(target = self.__run, daemon = True)
+        self.__thread.start()
+
+
+    def write(self, text):
+        self.__queue.put(text)
+
+
+    def flush(self):
+        # Messages are written in queue order, so once this marker is reached, everything before it was written.
+        flushed = threading.Event()
+        self.__queue.put(flushed)
+        flushed.wait()
+
+
+    def __run(self):
+        batch = []
+        batch_deadline = None
+        while True:
+            try:
+                timeout = None if not batch else max(0.0, batch_deadline - time.monotonic())
+                item = self.__queue.get(timeout = timeout)
+            except queue.Empty:
+                self.__write_batch(batch)
+                continue
+            if isinstance(item, threading.Event):
+                self.__write_batch(batch)
+                item.set()
+                continue
+            if not batch:
+                batch_deadline = time.monotonic() + self.__flush_interval
+            batch.append(item)
+            if len(batch) >= self.__flush_size:
+                self.__write_batch(batch)
+
+
+    @staticmethod
+    def __write_batch(batch):
+        if batch:
+            # sys.stdout is looked up on every write, since colorama may have wrapped it since the last one.
+            sys.stdout.write("".join(batch))
+            batch.clear()
+        sys.stdout.flush()
+
+
 if __name__ == "__main__":
     logger = Logger()
     logger.debug_log_all_styles()
@@ -0,0 +1,119 @@
+import collections
+import os
+import re
+from pathlib import PureWindowsPath
+from xml.etree import ElementTree
+
+from andeart.lullapy.easypath import EasyPath
+from andeart.lullapy.statefile import StateFile
+
+
+class SolutionParser:
+    cache_file_name = "slngraph-cache.json"
+    # Matches lines like: Project("{FAE04EC0-...}") = "Name", "Dir\Name.csproj", "{PROJECT-GUID}"
+    __project_line_regex = re.compile(r'^Project\("\{(?P<type>[^}]+)\}"\)\s*=\s*"(?P<name>[^"]*)",\s*'
+                                      r'"(?P<path>[^"]*)",\s*"\{(?P<guid>[^}]+)\}"')
+
+
+    @staticmethod
+    def get_projects(sln_path):
+        return [SolutionProject(*project) for project in SolutionParser.__parse_sln(sln_path)["projects"]]
+
+
+    @staticmethod
+    def get_project_graph(sln_path, use_cache = True):
+        # Maps each project path in the solution to the sorted paths of the solution projects it depends on, through
+        # either solution-level ProjectDependencies or ProjectReference items. Parsed files are cached by size and
+        # mtime, so repeat runs only re-read the files that changed.
+        sln_path = EasyPath.get_absolute_path(sln_path)
+        cache_file = StateFile(EasyPath.get_directory(sln_path), SolutionParser.cache_file_name)
+        cache = cache_file.load() if use_cache else {}
+        new_cache = {}
+
+        sln_info = SolutionParser.__parse_cached(cache, new_cache, sln_path, SolutionParser.__parse_sln)
+        project_paths_by_guid = {guid: path for (name, path, guid) in sln_info["projects"]}
+        # Windows paths are case-insensitive, and a ProjectReference may not spell a path the way the .sln does. So
+        # references are matched by their normcase'd path, and mapped back to the solution's spelling of it.
+        project_paths_by_key = {os.path.normcase(path): path for path in project_paths_by_guid.values()}
+        graph = {}
+        for (name, project_path, guid) in sln_info["projects"]:
+            dependencies = {project_paths_by_guid[dependency_guid]
+                            for dependency_guid in sln_info["dependencies"].get(guid, [])
+                            if dependency_guid in project_paths_by_guid}
+            if EasyPath.is_file(project_path):
+                references = SolutionParser.__parse_cached(cache, new_cache, project_path,
+                                                           SolutionParser.__parse_project_references)
+                dependencies.update(project_paths_by_key[os.path.normcase(reference)] for reference in references
+                                    if os.path.normcase(reference) in project_paths_by_key)
+            dependencies.discard(project_path)
+            graph[project_path] = sorted(dependencies)
+
+        if use_cache:
+            cache_file.save(new_cache)
+        return graph
+
+
+    @staticmethod
+    def __parse_cached(cache, new_cache, file_path, parse):
+        stat = os.stat(file_path)
+        entry = cache.get(str(file_path))
+        if entry is None or entry["size"] != stat.st_size or entry["mtime_ns"] != stat.st_mtime_ns:
+            entry = {"size": stat.st_size, "mtime_ns": stat.st_mtime_ns, "value": parse(file_path)}
+        new_cache[str(file_path)] = entry
+        return entry["value"]
+
+
+    @staticmethod
+    def __parse_sln(sln_path):
+        sln_dir = EasyPath.get_absolute_path(EasyPath.get_directory(sln_path))
+        projects = []
+        dependencies = {}
+        current_guid = None
+        in_dependencies_section = False
+        with open(sln_path, encoding = "utf-8-sig") as sln_file:
+            for line in sln_file:
+                line = line.strip()
+                match = SolutionParser.__project_line_regex.match(line)
+                if match is not None:
+                    current_guid = match.group("guid").upper()
+                    # Solution folders are listed as projects too, but their path is not a project file.
+                    relative_path = match.group("path")
+                    if relative_path.lower().endswith("proj"):
+                        # .sln files always use Windows separators.
+                        project_path = SolutionParser.__normalise_path(sln_dir, relative_path)
+                        projects.append([match.group("name"), project_path, current_guid])
+                elif line.startswith("ProjectSection(ProjectDependencies)"):
+                    in_dependencies_section = True
+                elif line == "EndProjectSection":
+                    in_dependencies_section = False
+                elif line == "EndProject":
+                    current_guid = None
+                elif in_dependencies_section and current_guid is not None:
+                    # Dependency lines look like: {DEPENDENCY-GUID} = {DEPENDENCY-GUID}
+                    dependency_guid = line.split("=", 1)[0].strip().strip("{}").upper()
+                    dependencies.setdefault(current_guid, []).append(dependency_guid)
+        return {"projects": projects, "dependencies": dependencies}
+
+
+    @staticmethod
+    def __parse_project_references(project_path):
+        project_dir = EasyPath.get_directory(project_path)
+        references = []
+        try:
+            file_root = ElementTree.parse(project_path).getroot()
+        except ElementTree.ParseError:
+            return references
+        for elem in file_root.iter():
+            if isinstance(elem.tag, str) and elem.tag.rsplit("}", 1)[-1] == "ProjectReference":
+                include = elem.get("Include")
+                if include:
+                    references.append(SolutionParser.__normalise_path(project_dir, include))
+        return references
+
+
+    @staticmethod
+    def __normalise_path(base_dir, windows_relative_path):
+        return os.path.normpath(str(EasyPath.combine(base_dir, PureWindowsPath(windows_relative_path).as_posix())))
+
+
+SolutionProject = collections.namedtuple("SolutionProject", ["name", "path", "guid"])
@@ -0,0 +1,41 @@
+import json
+import os
+import threading
+
+from andeart.lullapy.easypath import EasyPath
+
+
+class StateFile:
+    state_dir_name = ".lullapy"
+
+
+    def __init__(self, root_dir, name, version = 1):
+        # State is kept in a hidden directory inside root_dir (usually the solution directory).
+        self.path = EasyPath.combine(EasyPath.combine(root_dir, self.state_dir_name), name)
+        self.__version = version
+
+
+    def load(self):
+        # A missing, unreadable or outdated state file is treated the same as an empty one.
+        try:
+            with open(self.path, encoding = "utf-8") as state_file:
+                state = json.load(state_file)
+        except (OSError, ValueError):
+            return {}
+        if not isinstance(state, dict) or state.get("version") != self.__version:
+            return {}
+        return state.get("data", {})
+
+
+    def save(self, data):
+        self.path.parent.mkdir(parents = True, exist_ok = True)
+        # Write to a temporary file first so a crash or a concurrent run never leaves a half-written state file.
+        temp_path = self.path.with_name(f"{self.path.name}.{os.getpid()}.{threading.get_ident()}.tmp")
+        with open(temp_path, "w", encoding = "utf-8") as state_file:
+            json.dump({"version": self.__version, "data": data}, state_file)
+        os.replace(temp_path, self.path)
+
+
+    def clear(self):
+        if EasyPath.is_file(self.path):
+            self.path.unlink()
@@ -0,0 +1,187 @@
+import argparse
+import collections
+import contextlib
+import sqlite3
+from datetime import datetime
+
+from andeart.lullapy.easypath import EasyPath
+from andeart.lullapy.shyprint import LogLevel, Logger
+from andeart.lullapy.statefile import StateFile
+from andeart.lullapy.traceprofile import TraceProfiler
+
+
+class TestHistory:
+    db_file_name = "testhistory.db"
+    __schema = ["CREATE TABLE IF NOT EXISTS runs (id INTEGER PRIMARY KEY AUTOINCREMENT, suite TEXT NOT NULL, "
+                "started_at TEXT NOT NULL)",
+                "CREATE TABLE IF NOT EXISTS results (run_id INTEGER NOT NULL REFERENCES runs(id), name TEXT NOT NULL, "
+                "outcome TEXT NOT NULL, duration REAL NOT NULL)",
+                "CREATE INDEX IF NOT EXISTS runs_suite ON runs (suite, id)",
+                "CREATE INDEX IF NOT EXISTS results_run_id ON results (run_id)"]
+    # Takes the suite and run count as parameters.
+    __recent_runs_query = "SELECT id FROM runs WHERE suite = ? ORDER BY id DESC LIMIT ?"
+
+
+    def __init__(self, db_path):
+        # Each run belongs to a suite (ex: a test assembly, or one Unity test mode and filter), and history queries only
+        # ever look at the most recent runs of one suite.
+        self.db_path = db_path
+        EasyPath.get_absolute_path(db_path).parent.mkdir(parents = True, exist_ok = True)
+        with self.__connect() as connection, connection:
+            for statement in self.__schema:
+                connection.execute(statement)
+
+
+    @staticmethod
+    def get_default_path(root_dir):
+        return EasyPath.combine(EasyPath.combine(root_dir, StateFile.state_dir_name), TestHistory.db_file_name)
+
+
+    def record_run(self, suite, test_cases):
+        # test_cases are TestCaseResults, usually streamed from TestResults.iter_test_cases. Returns how many were
+        # recorded.
+        with self.__connect() as connection, connection:
+            run_id = connection.execute("INSERT INTO runs (suite, started_at) VALUES (?, ?)",
+                                        (suite, datetime.now().isoformat())).lastrowid
+            cursor = connection.executemany("INSERT INTO results (run_id, name, outcome, duration) VALUES (?, ?, ?, ?)",
+                                            ((run_id, test_case.name, test_case.outcome, test_case.duration)
+                                             for test_case in test_cases))
+            return cursor.rowcount
+
+
+    def get_suites(self):
+        with self.__connect() as connection:
+            return [row[0] for row in connection.execute("SELECT DISTINCT suite FROM runs ORDER BY suite")]
+
+
+    def get_recent_failures(self, suite, run_count):
+        # Names of tests that failed in any of the last run_count runs, most recently failed first.
+        with self.__connect() as connection:
+            rows = connection.execute(f"SELECT name FROM results WHERE run_id IN ({self.__recent_runs_query}) AND "
+                                      "outcome = 'Failed' GROUP BY name ORDER BY MAX(run_id) DESC, name",
+                                      (suite, run_count))
+            return [row[0] for row in rows]
+
+
+    def get_durations(self, suite, run_count):
+        # Average duration in seconds of each test that ran in the last run_count runs. Skipped tests are left out.
+        with self.__connect() as connection:
+            rows = connection.execute(f"SELECT name, AVG(duration) FROM results WHERE run_id IN "
+                                      f"({self.__recent_runs_query}) AND outcome != 'Skipped' GROUP BY name",
+                                      (suite, run_count))
+            return {name: duration for (name, duration) in rows}
+
+
+    def get_slowest(self, suite, run_count, count):
+        with self.__connect() as connection:
+            rows = connection.execute(f"SELECT name, AVG(duration), COUNT(*) FROM results WHERE run_id IN "
+                                      f"({self.__recent_runs_query}) AND outcome != 'Skipped' GROUP BY name "
+                                      "ORDER BY AVG(duration) DESC, name LIMIT ?", (suite, run_count, count))
+            return [SlowTest(*row) for row in rows]
+
+
+    def get_flakiest(self, suite, run_count, count):
+        # A test is flaky if it both passed and failed in the last run_count runs. Tests whose outcome flipped more
+        # often are flakier than tests that failed once after always passing.
+        flips = collections.Counter()
+        failed_counts = collections.Counter()
+        run_counts = collections.Counter()
+        last_outcomes = {}
+        with self.__connect() as connection:
+            rows = connection.execute(f"SELECT name, outcome FROM results WHERE run_id IN ({self.__recent_runs_query}) "
+                                      "AND outcome != 'Skipped' ORDER BY name, run_id", (suite, run_count))
+            for (name, outcome) in rows:
+                if name in last_outcomes and last_outcomes[name] != outcome:
+                    flips[name] += 1
+                last_outcomes[name] = outcome
+                run_counts[name] += 1
+                if outcome == "Failed":
+                    failed_counts[name] += 1
+
+        flaky_names = sorted(flips, key = lambda name: (-flips[name], -failed_counts[name], name))[:count]
+        return [FlakyTest(name, flips[name], failed_counts[name], run_counts[name]) for name in flaky_names]
+
+
+    def __connect(self):
+        return contextlib.closing(sqlite3.connect(str(self.db_path), timeout = 30))
+
+
+class TestHistoryReport:
+
+    # noinspection SpellCheckingInspection
+    def __init__(self, silent = False):
+        print("TestHistoryReport.")
+
+        # Initialize shyprint
+        self.__logger = Logger(self)
+        self.__logger.silent = silent
+
+        # Parse CLI args
+        parser = argparse.ArgumentParser(description = "Report the slowest and flakiest tests in a test history.")
+        parser.add_argument("--dbpath", "-d", type = str, metavar = "HistoryPath", default = None,
+                            help = "The path to the test history database. NetTester keeps it in the .lullapy "
+                                   "directory next to the tests assembly, and UnityTester in the one in the project.")
+        parser.add_argument("--suite", "-s", type = str, metavar = "Suite", default = None,
+                            help = "The test suite to report on. Reports on every suite in the history by default.")
+        parser.add_argument("--runs", "-n", type = int, metavar = "RunCount", default = 20,
+                            help = "The number of most recent runs of each suite to report on.")
+        parser.add_argument("--count", "-k", type = int, metavar = "TestCount", default = 10,
+                            help = "The number of slowest and flakiest tests to list.")
+        TraceProfiler.add_arguments(parser)
+        args = parser.parse_args()
+        TraceProfiler.enable_from_args(args)
+        self.__db_path = args.dbpath
+        self.__suite = args.suite
+        self.__run_count = args.runs
+        self.__test_count = args.count
+
+        self.__logger.log(f"Test history path: {self.__db_path}", LogLevel.WARNING)
+
+        if self.__db_path is None:
+            self.__exit_with_error(1, "Test history path was not provided.", parser.format_help())
+
+        if not EasyPath.is_file(self.__db_path):
+            self.__exit_with_error(1, "Test history path is not a valid file.", parser.format_help())
+
+        self.__history = TestHistory(self.__db_path)
+
+
+    def report(self):
+        suites = self.__history.get_suites() if self.__suite is None else [self.__suite]
+        for suite in suites:
+            self.__logger.log_linebreaks(1)
+            self.__logger.log(f"Suite: {suite}", LogLevel.SUCCESS)
+
+            self.__logger.log(f"Slowest tests over the last {self.__run_count} runs:", LogLevel.WARNING)
+            for slow_test in self.__history.get_slowest(suite, self.__run_count, self.__test_count):
+                self.__logger.log(f"{slow_test.duration:10.3f}s  {slow_test.name} ({slow_test.run_count} runs)")
+
+            flaky_tests = self.__history.get_flakiest(suite, self.__run_count, self.__test_count)
+            if not flaky_tests:
+                self.__logger.log(f"No flaky tests over the last {self.__run_count} runs.", LogLevel.SUCCESS)
+                continue
+            self.__logger.log(f"Flakiest tests over the last {self.__run_count} runs:", LogLevel.WARNING)
+            for flaky_test in flaky_tests:
+                self.__logger.log(f"{flaky_test.flip_count:4} flips, failed {flaky_test.failed_count} of "
+                                  f"{flaky_test.run_count} runs  {flaky_test.name}", LogLevel.ERROR)
+
+
+    def __exit_with_error(self, error_code, error_msg, usage_info = None):
+        self.__logger.log(f"ERROR! Exiting...\nError code: {str(error_code)}\nError message: {error_msg}",
+                          LogLevel.ERROR)
+        if usage_info is not None:
+            self.__logger.log(usage_info, LogLevel.WARNING)
+        self.__logger.flush()
+        exit(error_code)
+
+
+# Duration is the average duration in seconds over the runs the test ran in.
+SlowTest = collections.namedtuple("SlowTest", ["name", "duration", "run_count"])
+
+# Flip count is the number of times the outcome changed between consecutive runs.
+FlakyTest = collections.namedtuple("FlakyTest", ["name", "flip_count", "failed_count", "run_count"])
+
+
+if __name__ == "__main__":
+    history_report = TestHistoryReport(False)
+    history_report.report()
@@ -0,0 +1,294 @@
+import collections
+import copy
+import heapq
+from xml.etree import ElementTree
+from xml.parsers import expat
+
+from andeart.lullapy.shyprint import LogLevel
+
+
+class TestResults:
+    trx_namespace = "http://microsoft.com/schemas/VisualStudio/TeamTest/2010"
+    # Children of these TRX sections are per-test, so they are concatenated when merging.
+    __trx_merged_sections = ["TestDefinitions", "TestEntries", "Results"]
+    __failed_outcomes = {"Failed", "Failure", "Error", "Timeout", "Aborted"}
+    __passed_outcomes = {"Passed", "Success"}
+    __nunit_summed_attributes = ["testcasecount", "total", "passed", "failed", "inconclusive", "skipped", "asserts"]
+
+
+    @staticmethod
+    def iter_test_cases(results_path):
+        # Streams the test cases of an NUnit (Unity TestResults) or TRX file without loading the whole document.
+        # Each element is cleared and removed from its parent once it has been read, so memory stays flat however large
+        # the file is (a cleared element alone would still leave an empty shell behind in its parent).
+        open_elems = []
+        # Data-driven TRX tests nest a UnitTestResult per data row under their parent's InnerResults. Only the parent
+        # is yielded, since it already holds the outcome and duration of all its rows.
+        inner_results_depth = 0
+        for (event, elem) in ElementTree.iterparse(str(results_path), events = ("start", "end")):
+            if event == "start":
+                open_elems.append(elem)
+            else:
+                open_elems.pop()
+            tag = elem.tag.rsplit("}", 1)[-1]
+            if tag == "InnerResults":
+                inner_results_depth += 1 if event == "start" else -1
+                continue
+            if event != "end":
+                continue
+            if tag == "test-case":
+                yield TestResults.__read_nunit_case(elem)
+            elif tag == "UnitTestResult" and inner_results_depth == 0:
+                yield TestResults.__read_trx_case(elem)
+            elif tag not in ("test-suite", "UnitTest", "TestEntry"):
+                continue
+            elem.clear()
+            if open_elems:
+                open_elems[-1].remove(elem)
+
+
+    @staticmethod
+    def summarize(test_cases, slowest_count = 10):
+        counts = collections.Counter()
+        total_duration = 0.0
+        failures = []
+        slowest = []
+        for test_case in test_cases:
+            counts[test_case.outcome] += 1
+            total_duration += test_case.duration
+            if test_case.outcome == "Failed":
+                failures.append(test_case)
+            # Keep only the slowest_count slowest cases in a min-heap, keyed by duration.
+            if slowest_count > 0:
+                entry = (test_case.duration, len(slowest), test_case)
+                if len(slowest) < slowest_count:
+                    heapq.heappush(slowest, entry)
+                elif test_case.duration > slowest[0][0]:
+                    heapq.heapreplace(slowest, entry)
+
+        slowest = [test_case for (duration, index, test_case) in sorted(slowest, key = lambda entry: -entry[0])]
+        return TestResultsSummary(sum(counts.values()), counts["Passed"], counts["Failed"], counts["Skipped"],
+                                  total_duration, failures, slowest)
+
+
+    @staticmethod
+    def log_summary(logger, summary):
+        logger.log_linebreaks(1)
+        for test_case in summary.failures:
+            logger.log(f"Failed: {test_case.name}", LogLevel.ERROR)
+            if test_case.message:
+                logger.log(test_case.message.strip())
+        if summary.slowest:
+            logger.log(f"Slowest {len(summary.slowest)} tests:", LogLevel.WARNING)
+            for test_case in summary.slowest:
+                logger.log(f"{test_case.duration:10.3f}s  {test_case.name}")
+        logger.log(f"Test results: {summary.total} total, {summary.passed} passed, {summary.failed} failed, "
+                   f"{summary.skipped} skipped. Total test time: {summary.duration:.2f}s.",
+                   LogLevel.SUCCESS if summary.failed == 0 else LogLevel.ERROR)
+
+
+    @staticmethod
+    def merge_trx(trx_paths, merged_path):
+        # Merges TRX files from runs of the same test assembly into one, summing the result counters.
+        # Returns the merged counters.
+        # A test can run in more than one of the runs (ex: vstest matches /Tests values as substrings of test names),
+        # so only the first result of each test id is kept, and the outcomes of the others are left out of the counters.
+        ns = {"t": TestResults.trx_namespace}
+        merged_file = ElementTree.parse(str(trx_paths[0]))
+        merged_root = merged_file.getroot()
+        merged_counters = merged_root.find("t:ResultSummary/t:Counters", ns)
+        seen_test_ids = {result.get("testId") for result in merged_root.iterfind("t:Results/t:UnitTestResult", ns)
+                         if result.get("testId") is not None}
+        for trx_path in trx_paths[1:]:
+            trx_root = ElementTree.parse(str(trx_path)).getroot()
+            duplicate_outcomes = TestResults.__remove_duplicate_trx_results(trx_root, seen_test_ids)
+            for section_name in TestResults.__trx_merged_sections:
+                merged_section = merged_root.find(f"t:{section_name}", ns)
+                section = trx_root.find(f"t:{section_name}", ns)
+                if section is None:
+                    continue
+                if merged_section is None:
+                    merged_root.append(copy.deepcopy(section))
+                    continue
+                merged_section.extend(section)
+            counters = trx_root.find("t:ResultSummary/t:Counters", ns)
+            if merged_counters is not None and counters is not None:
+                for name, value in counters.attrib.items():
+                    merged_counters.set(name, str(int(merged_counters.get(name, "0")) + int(value)))
+                for outcome in duplicate_outcomes:
+                    # Counter names are the outcomes in camel case, ex: "NotExecuted" is counted in "notExecuted".
+                    names = ["total", outcome[:1].lower() + outcome[1:]]
+                    if outcome != "NotExecuted":
+                        names.append("executed")
+                    for name in names:
+                        if name in merged_counters.attrib:
+                            merged_counters.set(name, str(int(merged_counters.get(name)) - 1))
+
+        counters = {} if merged_counters is None else {name: int(value)
+                                                       for name, value in merged_counters.attrib.items()}
+        summary = merged_root.find("t:ResultSummary", ns)
+        if summary is not None:
+            summary.set("outcome", "Failed" if counters.get("failed", 0) > 0 else "Completed")
+        merged_file.write(str(merged_path), encoding = "utf-8", xml_declaration = True)
+        return counters
+
+
+    @staticmethod
+    def __remove_duplicate_trx_results(trx_root, seen_test_ids):
+        # Removes the results (and their test definitions and entries) of tests in seen_test_ids from trx_root, and adds
+        # the remaining test ids to seen_test_ids. Returns the outcomes of the removed results.
+        ns = {"t": TestResults.trx_namespace}
+        duplicate_test_ids = set()
+        duplicate_outcomes = []
+        results = trx_root.find("t:Results", ns)
+        if results is None:
+            return duplicate_outcomes
+        for result in results.findall("t:UnitTestResult", ns):
+            test_id = result.get("testId")
+            if test_id is not None and test_id in seen_test_ids:
+                results.remove(result)
+                duplicate_test_ids.add(test_id)
+                duplicate_outcomes.append(result.get("outcome", ""))
+        seen_test_ids.update(result.get("testId") for result in results.iterfind("t:UnitTestResult", ns)
+                             if result.get("testId") is not None)
+        for (section_name, tag, id_name) in [("TestDefinitions", "UnitTest", "id"),
+                                             ("TestEntries", "TestEntry", "testId")]:
+            section = trx_root.find(f"t:{section_name}", ns)
+            if section is None:
+                continue
+            for elem in section.findall(f"t:{tag}", ns):
+                if elem.get(id_name) in duplicate_test_ids:
+                    section.remove(elem)
+        return duplicate_outcomes
+
+
+    @staticmethod
+    def merge_nunit(results_paths, merged_path):
+        # Merges NUnit results files by concatenating the contents of their root elements under one new root with
+        # summed counters. Contents are copied as raw bytes, so even very large files are never loaded in full.
+        merged_root = None
+        totals = collections.Counter()
+        duration = 0.0
+        content_ranges = []
+        for results_path in results_paths:
+            (root, content_range) = TestResults.__find_root_content(results_path)
+            if merged_root is None:
+                # The merged root keeps the first root's other attributes (ex: engine-version, start-time).
+                merged_root = ElementTree.Element(root.tag, root.attrib)
+            # The runs happen in parallel, so the merged run takes as long as the longest one.
+            duration = max(duration, float(root.get("duration", "0")))
+            if content_range is None:
+                # A self-closing or empty root ran no test cases, whatever its counters say.
+                continue
+            for name in TestResults.__nunit_summed_attributes:
+                totals[name] += int(root.get(name, "0"))
+            content_ranges.append((results_path, content_range))
+
+        for name in TestResults.__nunit_summed_attributes:
+            merged_root.set(name, str(totals[name]))
+        merged_root.set("result", "Failed" if totals["failed"] > 0 else "Passed")
+        merged_root.set("duration", str(duration))
+        root_start = ElementTree.tostring(merged_root, encoding = "unicode")
+        # tostring writes an empty element as "<tag ... />", which is turned into a start tag here.
+        root_start = root_start[:-len(" />")] + ">"
+        with open(merged_path, "wb") as merged_file:
+            merged_file.write(b'<?xml version="1.0" encoding="utf-8"?>\n' + root_start.encode("utf-8"))
+            for (results_path, (content_start, content_end)) in content_ranges:
+                with open(results_path, "rb") as results_file:
+                    results_file.seek(content_start)
+                    remaining = content_end - content_start
+                    while remaining > 0:
+                        chunk = results_file.read(min(remaining, 1024 * 1024))
+                        if not chunk:
+                            break
+                        merged_file.write(chunk)
+                        remaining -= len(chunk)
+            merged_file.write(f"</{merged_root.tag}>".encode("utf-8"))
+
+
+    @staticmethod
+    def __find_root_content(results_path):
+        # Returns the root element (without children), and the byte range between its start and end tags, or None if
+        # it has no child elements. expat reports the byte offset of each event as it streams through the file, so the
+        # range is exact wherever the tags are and whatever their attribute values hold.
+        parser = expat.ParserCreate()
+        state = {"root": None, "has_children": False, "content_start": None, "content_end": None}
+
+        def on_content(*args):
+            if state["root"] is not None and state["content_start"] is None:
+                state["content_start"] = parser.CurrentByteIndex
+                parser.CharacterDataHandler = parser.CommentHandler = parser.ProcessingInstructionHandler = None
+
+        def on_start(name, attributes):
+            if state["root"] is None:
+                state["root"] = ElementTree.Element(name, attributes)
+                return
+            on_content()
+            state["has_children"] = True
+            parser.StartElementHandler = None
+
+        def on_end(name):
+            on_content()
+            # The last end tag is the root's.
+            state["content_end"] = parser.CurrentByteIndex
+
+        parser.StartElementHandler = on_start
+        parser.EndElementHandler = on_end
+        parser.CharacterDataHandler = parser.CommentHandler = parser.ProcessingInstructionHandler = on_content
+        with open(results_path, "rb") as results_file:
+            parser.ParseFile(results_file)
+        if not state["has_children"]:
+            return state["root"], None
+        return state["root"], (state["content_start"], state["content_end"])
+
+
+    @staticmethod
+    def parse_trx_duration(duration):
+        # TRX durations look like "00:00:01.2345678".
+        (hours, minutes, seconds) = duration.split(":")
+        return int(hours) * 3600 + int(minutes) * 60 + float(seconds)
+
+
+    @staticmethod
+    def __read_nunit_case(elem):
+        # NUnit 3 uses fullname/duration, NUnit 2 uses name/time.
+        name = elem.get("fullname") or elem.get("name")
+        duration = float(elem.get("duration") or elem.get("time") or 0.0)
+        message = None
+        for child in elem.iter():
+            if child.tag == "message":
+                message = child.text
+                break
+        return TestCaseResult(elem.get("id"), name, TestResults.__normalise_outcome(elem.get("result")), duration,
+                              message)
+
+
+    @staticmethod
+    def __read_trx_case(elem):
+        duration = elem.get("duration")
+        duration = 0.0 if duration is None else TestResults.parse_trx_duration(duration)
+        message = None
+        for child in elem.iter():
+            if child.tag.rsplit("}", 1)[-1] == "Message":
+                message = child.text
+                break
+        return TestCaseResult(elem.get("testId"), elem.get("testName"),
+                              TestResults.__normalise_outcome(elem.get("outcome")), duration, message)
+
+
+    @staticmethod
+    def __normalise_outcome(outcome):
+        if outcome in TestResults.__passed_outcomes:
+            return "Passed"
+        if outcome in TestResults.__failed_outcomes:
+            return "Failed"
+        return "Skipped"
+
+
+# Outcome is one of "Passed", "Failed" or "Skipped". Duration is in seconds.
+TestCaseResult = collections.namedtuple("TestCaseResult", ["id", "name", "outcome", "duration", "message"])
+
+TestResultsSummary = collections.namedtuple("TestResultsSummary", ["total", "passed", "failed", "skipped", "duration",
+                                                                   "failures", "slowest"])
+
+ElementTree.register_namespace("", TestResults.trx_namespace)
@@ -0,0 +1,152 @@
+import hashlib
+import os
+import platform
+import shutil
+from pathlib import Path
+
+from andeart.lullapy.easypath import EasyPath
+from andeart.lullapy.processrun import ProcessRunner
+from andeart.lullapy.shyprint import LogLevel, Logger
+from andeart.lullapy.statefile import StateFile
+
+
+class ToolFinder:
+    cache_file_name = "toolfind-cache.json"
+
+
+    def __init__(self, silent = False, use_cache = True):
+        self.__logger = Logger.get_logger("ToolFinder", silent)
+        self.__process_run = ProcessRunner(silent)
+        # Tool locations are per-machine, so the cache lives in the user's home directory rather than a solution's.
+        self.__cache_file = StateFile(Path.home(), self.cache_file_name)
+        self.__use_cache = use_cache
+        self.__logger.log("ToolFinder initialised.")
+
+
+    def find_msbuild(self):
+        if platform.system() != "Windows":
+            self.__logger.log("Not on Windows- MSBuild is usually available on PATH here.", LogLevel.WARNING)
+            return self.find_on_path("msbuild")
+
+        self.__logger.log("On Windows OS. Locating MSBuild via vswhere...")
+        vswhere_path = self.__locate_vs_where("ProgramFiles")
+        if vswhere_path is None:
+            # Try (x86) directory...
+            vswhere_path = self.__locate_vs_where("ProgramFiles(x86)")
+            if vswhere_path is None:
+                self.__logger.log("VS Installation was not found.", LogLevel.ERROR)
+                return None
+
+        # A cached location stays valid while vswhere (updated by the VS installer) and the VS installation directory
+        # are unchanged.
+        entry = self.__load_cache_entry("msbuild")
+        if entry is not None and entry["vswhere_path"] == vswhere_path and \
+                entry["vswhere_mtime_ns"] == self.__get_mtime_ns(vswhere_path) and \
+                entry["installation_mtime_ns"] == self.__get_mtime_ns(entry["installation_path"]) and \
+                EasyPath.is_file(entry["path"]):
+            self.__logger.log(f"Using cached MSBuild location: {entry['path']}", LogLevel.SUCCESS)
+            return entry["path"]
+
+        vs_installation_path = self.__locate_vs_installation(vswhere_path)
+        if vs_installation_path is None:
+            self.__logger.log("VS Installation was not found.", LogLevel.ERROR)
+            return None
+
+        msbuild_path = None
+        vs_msbuild_pattern = "MSBuild/*/Bin/MSBuild.exe"
+        locations = EasyPath.glob(vs_installation_path, vs_msbuild_pattern)
+        for location in sorted(locations, reverse = True):
+            if EasyPath.is_file(location):
+                msbuild_path = str(location)
+                break
+        if msbuild_path is None:
+            return None
+
+        self.__save_cache_entry("msbuild", {"vswhere_path": vswhere_path,
+                                            "vswhere_mtime_ns": self.__get_mtime_ns(vswhere_path),
+                                            "installation_path": vs_installation_path,
+                                            "installation_mtime_ns": self.__get_mtime_ns(vs_installation_path),
+                                            "path": msbuild_path})
+        return msbuild_path
+
+
+    def find_on_path(self, tool_name):
+        # A cached location stays valid while PATH and the executable itself are unchanged.
+        path_hash = hashlib.sha1((os.environ.get("PATH", "") + os.environ.get("PATHEXT", "")).encode()).hexdigest()
+        entry = self.__load_cache_entry(tool_name)
+        if entry is not None and entry["path_hash"] == path_hash and \
+                entry["mtime_ns"] == self.__get_mtime_ns(entry["path"]):
+            self.__logger.log(f"Using cached {tool_name} location: {entry['path']}", LogLevel.SUCCESS)
+            return entry["path"]
+
+        tool_path = shutil.which(tool_name)
+        if tool_path is None:
+            self.__logger.log(f"{tool_name} was not found on PATH. Running it by name.", LogLevel.WARNING)
+            return tool_name
+
+        self.__logger.log(f"{tool_name} was found at: {tool_path}", LogLevel.SUCCESS)
+        self.__save_cache_entry(tool_name, {"path_hash": path_hash, "path": tool_path,
+                                            "mtime_ns": self.__get_mtime_ns(tool_path)})
+        return tool_path
+
+
+    def find_nuget(self):
+        return self.find_on_path("nuget")
+
+
+    def find_dotnet(self):
+        return self.find_on_path("dotnet")
+
+
+    def clear_cache(self):
+        self.__cache_file.clear()
+
+
+    def __locate_vs_installation(self, vswhere_path):
+        vswhere_cmd = f"{vswhere_path} -latest -requires Microsoft.Component.MSBuild"
+        final_path = None
+
+        result = self.__process_run.run_line(vswhere_cmd)
+        for item in result.output.splitlines():
+            split_item = item.split(":", 1)
+            if split_item[0] == "installationPath":
+                final_path = split_item[1].strip()
+                self.__logger.log(f"VS Installation was found at: {final_path}", LogLevel.SUCCESS)
+                self.__logger.log_linebreaks(2)
+
+        return final_path
+
+
+    def __locate_vs_where(self, program_files_var):
+        vswhere_sub_path = "/Microsoft Visual Studio/Installer/vswhere.exe"
+        program_files_location = os.environ.get(program_files_var)
+        if program_files_location is None:
+            self.__logger.log(f"No {program_files_var} variable was found in environment.", LogLevel.WARNING)
+            return None
+        vswhere_path = program_files_location + vswhere_sub_path
+        if not EasyPath.is_file(vswhere_path):
+            self.__logger.log(f"No executable found at {vswhere_path}", LogLevel.WARNING)
+            return None
+        return vswhere_path
+
+
+    def __load_cache_entry(self, tool_name):
+        if not self.__use_cache:
+            return None
+        return self.__cache_file.load().get(tool_name)
+
+
+    def __save_cache_entry(self, tool_name, entry):
+        if not self.__use_cache:
+            return
+        cache = self.__cache_file.load()
+        cache[tool_name] = entry
+        self.__cache_file.save(cache)
+
+
+    @staticmethod
+    def __get_mtime_ns(location):
+        try:
+            return os.stat(location).st_mtime_ns
+        except OSError:
+            return None
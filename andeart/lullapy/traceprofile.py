@@ -0,0 +1,118 @@
+import atexit
+import cProfile
+import json
+import os
+import subprocess
+import sys
+import threading
+
+from andeart.lullapy.easypath import EasyPath
+
+
+class TraceProfiler:
+    # Records the phases of a run (Logger spans) and every child process (ProcessRunner commands) as Chrome trace
+    # events, which chrome://tracing and https://ui.perfetto.dev can open. The trace is written when the process exits.
+    # Enabled by each tool's --profile option, or by setting this env var to the trace path.
+    profile_env_var = "LULLAPY_PROFILE"
+    # If also set, a cProfile dump of the Python code is written next to the trace, with a .pstats extension.
+    cprofile_env_var = "LULLAPY_CPROFILE"
+    __lock = threading.Lock()
+    __trace_path = None
+    __events = []
+    # Threads of this process get a track each, named by thread id. Every child process is a trace process of its own,
+    # named by its pid, so that child pids can never be confused with thread ids.
+    __thread_names = {}
+    __child_process_names = {}
+    __profile = None
+
+
+    @staticmethod
+    def add_arguments(parser):
+        parser.add_argument("--profile", type = str, metavar = "TracePath", default = None,
+                            help = "Write a Chrome trace of the run's phases and child processes to this path, for "
+                                   "chrome://tracing or ui.perfetto.dev. Can also be set with the "
+                                   f"{TraceProfiler.profile_env_var} env var.")
+        parser.add_argument("--cprofile", action = "store_true", default = False,
+                            help = "With --profile, also write a cProfile dump of the Python code next to the trace, "
+                                   "with a .pstats extension.")
+
+
+    @staticmethod
+    def enable_from_args(args):
+        if args.profile is not None:
+            TraceProfiler.enable(args.profile, args.cprofile)
+
+
+    @staticmethod
+    def enable_from_env():
+        if os.environ.get(TraceProfiler.profile_env_var):
+            TraceProfiler.enable(os.environ[TraceProfiler.profile_env_var],
+                                 bool(os.environ.get(TraceProfiler.cprofile_env_var)))
+
+
+    @staticmethod
+    def enable(trace_path, use_cprofile = False):
+        # Only the first call has an effect, so the --profile option and the env var can both be used.
+        with TraceProfiler.__lock:
+            if TraceProfiler.__trace_path is not None:
+                return
+            TraceProfiler.__trace_path = trace_path
+            atexit.register(TraceProfiler.write)
+        if use_cprofile:
+            # cProfile only profiles the thread it was enabled on, which is the main thread for every tool.
+            TraceProfiler.__profile = cProfile.Profile()
+            TraceProfiler.__profile.enable()
+
+
+    @staticmethod
+    def is_enabled():
+        return TraceProfiler.__trace_path is not None
+
+
+    @staticmethod
+    def add_span(name, start, duration, owner_name):
+        # start is a time.perf_counter() value, and duration is in seconds. Spans are drawn on their thread's track.
+        if not TraceProfiler.is_enabled():
+            return
+        thread = threading.current_thread()
+        with TraceProfiler.__lock:
+            TraceProfiler.__events.append({"name": name, "cat": "phase", "ph": "X", "ts": start * 1e6,
+                                           "dur": duration * 1e6, "pid": os.getpid(), "tid": thread.native_id,
+                                           "args": {"owner": owner_name}})
+            TraceProfiler.__thread_names.setdefault(thread.native_id, thread.name)
+
+
+    @staticmethod
+    def add_process(args, pid, start, duration, status, usage = None):
+        # Each child process is drawn as a trace process of its own, named after its executable and pid.
+        if not TraceProfiler.is_enabled():
+            return
+        event_args = {"command": subprocess.list2cmdline(args), "status": status}
+        if usage is not None:
+            event_args.update({name: value for name, value in usage._asdict().items() if value is not None})
+        executable_name = os.path.basename(str(args[0])) if args else "process"
+        with TraceProfiler.__lock:
+            TraceProfiler.__events.append({"name": executable_name, "cat": "process", "ph": "X", "ts": start * 1e6,
+                                           "dur": duration * 1e6, "pid": pid, "tid": pid, "args": event_args})
+            TraceProfiler.__child_process_names[pid] = f"{executable_name} (pid {pid})"
+
+
+    @staticmethod
+    def write():
+        EasyPath.get_absolute_path(TraceProfiler.__trace_path).parent.mkdir(parents = True, exist_ok = True)
+        if TraceProfiler.__profile is not None:
+            TraceProfiler.__profile.disable()
+            TraceProfiler.__profile.dump_stats(os.path.splitext(TraceProfiler.__trace_path)[0] + ".pstats")
+            TraceProfiler.__profile = None
+
+        pid = os.getpid()
+        with TraceProfiler.__lock:
+            events = [{"name": "process_name", "ph": "M", "pid": pid,
+                       "args": {"name": os.path.basename(sys.argv[0]) or "lullapy"}}]
+            events += [{"name": "thread_name", "ph": "M", "pid": pid, "tid": thread_id, "args": {"name": thread_name}}
+                       for thread_id, thread_name in TraceProfiler.__thread_names.items()]
+            events += [{"name": "process_name", "ph": "M", "pid": child_pid, "args": {"name": child_name}}
+                       for child_pid, child_name in TraceProfiler.__child_process_names.items()]
+            events += TraceProfiler.__events
+        with open(TraceProfiler.__trace_path, "w", encoding = "utf-8") as trace_file:
+            json.dump({"traceEvents": events, "displayTimeUnit": "ms"}, trace_file)
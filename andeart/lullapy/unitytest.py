@@ -1,14 +1,40 @@
 import argparse
+import functools
 import os
-from xml.etree import ElementTree
+import platform
+import re
+import shutil
+import threading
+import time
 
 from andeart.lullapy.easypath import EasyPath
+from andeart.lullapy.logtail import LogTailer
 from andeart.lullapy.processrun import ProcessRunner
 from andeart.lullapy.shyprint import LogLevel, Logger
+from andeart.lullapy.testhistory import TestHistory
+from andeart.lullapy.testresults import TestResults
+from andeart.lullapy.traceprofile import TraceProfiler
 
 
 class UnityTester:
     test_results_file_pattern = "TestResults-*.xml"
+    test_modes = ["editmode", "playmode"]
+    # Read-only project directories that cloned workspaces share with the project through links.
+    shared_dir_names = ["Assets"]
+    # Project directories that Unity writes to (ex: Packages/packages-lock.json, upgraded ProjectSettings assets), so
+    # cloned workspaces get a fresh copy of them on every run rather than a link that would write back to the project.
+    copied_dir_names = ["Packages", "ProjectSettings"]
+    library_dir_name = "Library"
+    # Named so that it never matches test_results_file_pattern, and is never picked up as a run's results.
+    merged_results_name = "MergedTestResults.xml"
+    log_file_name = "unity-lullapy.log"
+    # Log lines after which a run cannot succeed, so Unity is killed rather than waited on.
+    fatal_log_patterns = [r"error CS\d+", r"Scripts have compiler errors", r"No valid Unity Editor license",
+                          r"License is not active", r"Aborting batchmode due to failure"]
+    # Log lines worth showing while Unity runs. Matching is case-insensitive.
+    key_log_patterns = [r"\berror\b", r"exception", r"compil", r"license", r"test run"]
+    # The number of most recent runs in the test history that durations and recent failures are taken from.
+    history_run_count = 10
 
 
     # noinspection SpellCheckingInspection
@@ -25,20 +51,58 @@ class UnityTester:
                             help = "The path to the Unity executable.")
         parser.add_argument("--projectpath", "-p", type = str, metavar = "ProjectPath", default = None,
                             help = "The path to the Unity project to run tests in.")
-        parser.add_argument("--testmode", "-m", choices = ["editmode", "playmode"], type = str, metavar = "TestMode",
-                            default = "editmode", help = "The test-mode of tests to run, i.e. editmode or playmode.")
+        parser.add_argument("--testmode", "-m", type = str, metavar = "TestMode", default = "editmode",
+                            help = "The test-mode of tests to run, i.e. editmode or playmode. Use "
+                                   "\"editmode;playmode\" to run both at once in cloned workspaces.")
+        parser.add_argument("--testfilter", "-f", type = str, metavar = "TestFilter", action = "append", default = None,
+                            help = "A Unity -testFilter value. Repeat this to split the tests into partitions that run "
+                                   "at once in cloned workspaces.")
+        parser.add_argument("--workspacesdir", "-w", type = str, metavar = "WorkspacesPath", default = None,
+                            help = "The directory to keep cloned project workspaces in when running several test modes "
+                                   "or partitions at once. Clones share Assets, Packages and ProjectSettings with the "
+                                   "project through links and keep their own copy of its Library between runs. "
+                                   "Defaults to a hidden directory next to the project.")
+        parser.add_argument("--jobs", "-j", type = int, metavar = "JobCount", default = None,
+                            help = "The maximum number of Unity instances run at once. Runs every test mode and "
+                                   "partition at once by default. Otherwise, runs with recent failures in the test "
+                                   "history start first, followed by the longest runs.")
         parser.add_argument("--resultspath", "-r", type = str, metavar = "TestResultsPath", default = None,
-                            help = "The path to the test results output file.")
-
+                            help = "The path to the test results output file. With several test modes or partitions, "
+                                   "this is the merged results file.")
+        parser.add_argument("--logpath", "-l", type = str, metavar = "LogPath", default = None,
+                            help = "The path to the Unity log file, which is followed while Unity runs. Defaults to "
+                                   f"{self.log_file_name} in the Logs directory of the project (or of each cloned "
+                                   "workspace).")
+        parser.add_argument("--fatalpatterns", "-x", type = str, metavar = "FatalPatterns",
+                            default = ";".join(self.fatal_log_patterns),
+                            help = "Semicolon-separated regular expressions. Unity is killed as soon as its log has a "
+                                   "line that matches any of them.")
+        parser.add_argument("--allresults", "-a", action = "store_true", default = False,
+                            help = "Log every test case in the results. Only failed test cases are logged by default.")
+        parser.add_argument("--slowest", "-k", type = int, metavar = "SlowestCount", default = 10,
+                            help = "The number of slowest test cases to list in the results summary.")
+
+        TraceProfiler.add_arguments(parser)
         args = parser.parse_args()
+        TraceProfiler.enable_from_args(args)
         self.__unity_path = args.unitypath
         self.__project_path = args.projectpath
-        self.__test_mode = args.testmode
+        self.__test_modes = args.testmode.split(";")
+        self.__test_filters = args.testfilter or [None]
+        self.__workspaces_path = args.workspacesdir
+        self.__job_count = args.jobs
         self.__results_path = args.resultspath
+        self.__log_all_results = args.allresults
+        self.__slowest_count = args.slowest
+        self.__log_path = args.logpath
+        self.__fatal_line = None
+        self.__fatal_lock = threading.Lock()
+        self.__key_log_regex = re.compile("|".join(self.key_log_patterns), re.IGNORECASE)
 
         self.__logger.log(
             f"Unity executable path: {self.__unity_path}" + f"\nProject path: {self.__project_path}" + f"\nTest mode: "
-            f"{self.__test_mode}" + f"\nResults output path: {self.__results_path}", LogLevel.WARNING)
+            f"{self.__test_modes}" + f"\nTest filters: {self.__test_filters}" + f"\nResults output path: "
+            f"{self.__results_path}", LogLevel.WARNING)
 
         if self.__unity_path is None:
             self.__exit_with_error(1, "Unity executable was not provided for running tests.", parser.format_help())
@@ -46,6 +110,18 @@ class UnityTester:
         if self.__project_path is None:
             self.__exit_with_error(1, "Unity project that contains tests was not provided.", parser.format_help())
 
+        for test_mode in self.__test_modes:
+            if test_mode not in self.test_modes:
+                self.__exit_with_error(1, f"Test mode {test_mode} is not one of {self.test_modes}.",
+                                       parser.format_help())
+
+        try:
+            self.__fatal_log_regex = re.compile("|".join(f"(?:{pattern})" for pattern in args.fatalpatterns.split(";")
+                                                         if pattern))
+        except re.error as e:
+            self.__exit_with_error(1, f"Fatal log patterns are not valid regular expressions: {e}",
+                                   parser.format_help())
+
         if self.__results_path is None:
             self.__logger.log("Explicit test-results output file was not provided. Test results will be saved to the "
                               "default file.",
@@ -56,14 +132,30 @@ class UnityTester:
 
 
     def run_tests(self):
-        result = self.__run_unity_tests(self.__unity_path, self.__project_path, self.__test_mode, self.__results_path)
-
+        self.__verify_paths(self.__unity_path, self.__project_path)
+        # Every run is recorded in the test history inside the project, under its test mode and filter.
+        self.__history = TestHistory(TestHistory.get_default_path(self.__project_path))
+        if len(self.__test_modes) * len(self.__test_filters) > 1:
+            self.__run_parallel_tests()
+            return
+
+        start_time = time.time()
+        result = self.__run_unity_tests(self.__unity_path, self.__project_path, self.__test_modes[0],
+                                        self.__test_filters[0], self.__results_path)
+        self.__exit_if_fatal()
+
+        results_path = None
         if self.__results_path is not None and EasyPath.is_file(self.__results_path):
-            self.__log_unity_results(self.__results_path)
+            results_path = self.__results_path
         else:
             latest_results = self.__get_latest_test_results(self.__project_path)
             if latest_results is not None:
-                self.__log_unity_results(EasyPath.get_absolute_path(latest_results))
+                results_path = EasyPath.get_absolute_path(latest_results)
+        if results_path is not None:
+            self.__log_unity_results(results_path)
+            # Results from before this run are still logged as before, but must not be recorded again.
+            if os.path.getmtime(results_path) >= start_time:
+                self.__record_results(self.__test_modes[0], self.__test_filters[0], results_path)
 
         if result.status != 0:
             self.__exit_with_error(result.status, "Unity TestRunner tests were not run successfully.")
@@ -71,21 +163,213 @@ class UnityTester:
         self.__logger.log("Unity TestRunner tests were run successfully.", LogLevel.SUCCESS)
 
 
-    def __run_unity_tests(self, unity_app_path, project_path, test_mode, results_path):
+    def __run_parallel_tests(self):
         self.__logger.log_linebreaks(2)
-        self.__logger.log("Running Unity TestRunner tests...", LogLevel.WARNING)
+        self.__logger.log("Running Unity TestRunner tests in cloned workspaces...", LogLevel.WARNING)
+
+        project_path = EasyPath.get_absolute_path(self.__project_path)
+        workspaces_path = self.__workspaces_path
+        if workspaces_path is None:
+            workspaces_path = EasyPath.combine(project_path.parent, f".{project_path.name}-workspaces")
+
+        runs = self.__order_runs([(test_mode, test_filter) for test_mode in self.__test_modes
+                                  for test_filter in self.__test_filters])
+        cmd_lines = []
+        results_paths = []
+        log_paths = []
+        for index, (test_mode, test_filter) in enumerate(runs):
+            workspace_path = EasyPath.combine(workspaces_path, str(index + 1))
+            self.__logger.log(f"Preparing workspace {workspace_path} for {test_mode} tests"
+                              f"{'' if test_filter is None else ' matching ' + test_filter}...")
+            with self.__logger.span("prepare workspace"):
+                self.__prepare_workspace(project_path, workspace_path)
+            results_path = EasyPath.combine(workspace_path, "TestResults-lullapy.xml")
+            if EasyPath.is_file(results_path):
+                results_path.unlink()
+            results_paths.append(results_path)
+            log_path = self.__get_log_path(workspace_path)
+            log_paths.append(log_path)
+            cmd_lines.append(self.__get_unity_cmd_line(self.__unity_path, workspace_path, test_mode, test_filter,
+                                                       results_path, log_path))
+
+        with self.__logger.span("run Unity"):
+            results = self.__run_tailed(functools.partial(self.__process_run.run_many, cmd_lines,
+                                                          max_workers = self.__job_count or len(runs)), log_paths)
+        self.__exit_if_fatal()
+
+        for (test_mode, test_filter), results_path in zip(runs, results_paths):
+            if EasyPath.is_file(results_path):
+                self.__record_results(test_mode, test_filter, results_path)
+        existing_results_paths = [path for path in results_paths if EasyPath.is_file(path)]
+        if existing_results_paths:
+            merged_results_path = self.__results_path or EasyPath.combine(project_path, self.merged_results_name)
+            with self.__logger.span("merge results"):
+                TestResults.merge_nunit(existing_results_paths, merged_results_path)
+            self.__logger.log(f"Merged {len(existing_results_paths)} results files into {merged_results_path}.")
+            self.__log_unity_results(merged_results_path)
+
+        failed_runs = [(run, result) for run, result in zip(runs, results) if result.status != 0]
+        for (test_mode, test_filter), result in failed_runs:
+            self.__logger.log(f"Unity exited with {result.status} for {test_mode} tests"
+                              f"{'' if test_filter is None else ' matching ' + test_filter}.", LogLevel.ERROR)
+        if failed_runs:
+            self.__exit_with_error(failed_runs[0][1].status, "Unity TestRunner tests were not run successfully.")
+
+        self.__logger.log("Unity TestRunner tests were run successfully.", LogLevel.SUCCESS)
+
 
+    def __order_runs(self, runs):
+        # run_many starts runs in order, so this only matters when there are more runs than jobs. Runs that failed
+        # recently go first so their failures are reported sooner, then the longest runs, so that short runs fill in
+        # the gaps at the end rather than a long run starting last.
+        def get_order_key(run):
+            suite = self.__get_history_suite(*run)
+            has_failures = bool(self.__history.get_recent_failures(suite, self.history_run_count))
+            duration = sum(self.__history.get_durations(suite, self.history_run_count).values())
+            return not has_failures, -duration
+
+        return sorted(runs, key = get_order_key)
+
+
+    @staticmethod
+    def __get_history_suite(test_mode, test_filter):
+        return f"unity {test_mode}" if test_filter is None else f"unity {test_mode} {test_filter}"
+
+
+    def __record_results(self, test_mode, test_filter, results_path):
+        with self.__logger.span("record test history"):
+            count = self.__history.record_run(self.__get_history_suite(test_mode, test_filter),
+                                              TestResults.iter_test_cases(results_path))
+        self.__logger.log(f"Recorded {count} test results in the test history at {self.__history.db_path}.")
+
+
+    def __prepare_workspace(self, project_path, workspace_path):
+        workspace_path.mkdir(parents = True, exist_ok = True)
+        # Unity locks the project directory it runs in, so each run needs its own. Shared source directories are linked
+        # and the others are copied again on every run, so clones never go stale.
+        for dir_name in self.shared_dir_names:
+            source_path = EasyPath.combine(project_path, dir_name)
+            if EasyPath.is_dir(source_path):
+                self.__link_dir(source_path, EasyPath.combine(workspace_path, dir_name))
+        for dir_name in self.copied_dir_names:
+            source_path = EasyPath.combine(project_path, dir_name)
+            if EasyPath.is_dir(source_path):
+                copy_path = EasyPath.combine(workspace_path, dir_name)
+                self.__remove_dir(copy_path)
+                shutil.copytree(source_path, copy_path)
+
+        # Library is written to by Unity, so it must not be shared. Each clone keeps its own copy between runs and
+        # Unity updates it incrementally, so the project's Library is only copied into new clones.
+        source_library_path = EasyPath.combine(project_path, self.library_dir_name)
+        library_path = EasyPath.combine(workspace_path, self.library_dir_name)
+        if EasyPath.is_dir(source_library_path) and not EasyPath.is_dir(library_path):
+            self.__logger.log(f"Copying {source_library_path} to {library_path}...")
+            shutil.copytree(source_library_path, library_path)
+
+
+    def __link_dir(self, source_path, link_path):
+        if os.path.lexists(link_path) and os.path.realpath(link_path) == os.path.realpath(source_path):
+            return
+        self.__remove_dir(link_path)
+
+        try:
+            os.symlink(source_path, link_path, target_is_directory = True)
+            return
+        except OSError:
+            self.__logger.log(f"Could not symlink {link_path}.", LogLevel.WARNING)
+        # Creating symlinks needs extra privileges on Windows, but directory junctions do not.
+        if platform.system() == "Windows":
+            result = self.__process_run.run_args(["cmd", "/c", "mklink", "/J", str(link_path), str(source_path)])
+            if result.status == 0:
+                return
+        self.__logger.log(f"Could not link {link_path}. Copying {source_path} instead.", LogLevel.WARNING)
+        shutil.copytree(source_path, link_path)
+
+
+    @staticmethod
+    def __remove_dir(dir_path):
+        # Removes a linked or copied directory of a workspace, without touching the target of a link.
+        if not os.path.lexists(dir_path):
+            return
+        if os.path.islink(dir_path):
+            os.unlink(dir_path)
+        else:
+            # rmdir removes Windows junctions without touching their targets. Anything else is a stale copy.
+            try:
+                os.rmdir(dir_path)
+            except OSError:
+                shutil.rmtree(dir_path)
+
+
+    def __run_unity_tests(self, unity_app_path, project_path, test_mode, test_filter, results_path):
+        self.__logger.log_linebreaks(2)
+        self.__logger.log("Running Unity TestRunner tests...", LogLevel.WARNING)
+        log_path = self.__log_path or self.__get_log_path(project_path)
+        cmd_line = self.__get_unity_cmd_line(unity_app_path, project_path, test_mode, test_filter, results_path,
+                                             log_path)
+        with self.__logger.span("run Unity"):
+            return self.__run_tailed(functools.partial(self.__process_run.run_line, cmd_line), [log_path])
+
+
+    def __get_log_path(self, project_path):
+        return EasyPath.combine(EasyPath.combine(project_path, "Logs"), self.log_file_name)
+
+
+    def __run_tailed(self, run, log_paths):
+        # Unity writes little to stdout in batchmode, so its log files are followed while it runs instead.
+        tailers = []
+        for index, log_path in enumerate(log_paths):
+            if EasyPath.is_file(log_path):
+                os.remove(log_path)
+            os.makedirs(os.path.dirname(os.path.abspath(log_path)), exist_ok = True)
+            prefix = "" if len(log_paths) == 1 else f"[{index + 1}/{len(log_paths)}] "
+            tailers.append(LogTailer(log_path, functools.partial(self.__on_log_line, prefix)))
+        for tailer in tailers:
+            tailer.start()
+        try:
+            return run()
+        finally:
+            for tailer in tailers:
+                tailer.stop()
+
+
+    def __on_log_line(self, prefix, line):
+        if self.__fatal_log_regex.pattern and self.__fatal_log_regex.search(line):
+            with self.__fatal_lock:
+                is_first_fatal_line = self.__fatal_line is None
+                if is_first_fatal_line:
+                    self.__fatal_line = line
+            self.__logger.log(prefix + line, LogLevel.ERROR)
+            if is_first_fatal_line:
+                self.__logger.log("Fatal line found in Unity log. Killing Unity...", LogLevel.ERROR)
+            # Every fatal line kills again, which also catches parallel runs that only started after the first kill.
+            self.__process_run.terminate_all()
+        elif self.__key_log_regex.search(line):
+            self.__logger.log(prefix + line, LogLevel.WARNING)
+
+
+    def __exit_if_fatal(self):
+        if self.__fatal_line is not None:
+            self.__exit_with_error(1, f"Unity was killed early because its log reported: {self.__fatal_line.strip()}")
+
+
+    def __verify_paths(self, unity_app_path, project_path):
         if not EasyPath.is_file(unity_app_path):
             self.__exit_with_error(1, f"Unity app path: {unity_app_path} : is not an executable.")
 
         if not EasyPath.is_dir(project_path):
             self.__exit_with_error(1, f"Unity project path: {project_path} : is not a project directory.")
 
-        cmd_line = f"{unity_app_path} -batchmode -runTests -projectPath {project_path} -testPlatform {test_mode}"
+
+    @staticmethod
+    def __get_unity_cmd_line(unity_app_path, project_path, test_mode, test_filter, results_path, log_path):
+        cmd_line = f"{unity_app_path} -batchmode -runTests -projectPath {project_path} -testPlatform {test_mode} " \
+                   f"-logFile {log_path}"
+        if test_filter is not None:
+            cmd_line += f" -testFilter {test_filter}"
         if results_path is not None:
             cmd_line += f" -testResults {results_path}"
-
-        return self.__process_run.run_line(cmd_line)
+        return cmd_line
 
 
     def __get_latest_test_results(self, project_path):
@@ -98,19 +382,23 @@ class UnityTester:
 
 
     def __log_unity_results(self, results_path):
-        file = ElementTree.parse(str(results_path))
-        file_root = file.getroot()
-        # for test_case in file_root.findall("test-case"):
-        #     self.__logger.log(test_case)
+        # Results are streamed rather than parsed in one go, since TestResults files can be hundreds of MB.
+        test_cases = TestResults.iter_test_cases(results_path)
+        if self.__log_all_results:
+            test_cases = self.__log_test_cases(test_cases)
+        summary = TestResults.summarize(test_cases, self.__slowest_count)
+        TestResults.log_summary(self.__logger, summary)
+
 
-        for test_case in file.iter("test-case"):
+    def __log_test_cases(self, test_cases):
+        for test_case in test_cases:
             self.__logger.log_linebreaks(1)
-            self.__logger.log("Test case ID: " + test_case.get("id"), LogLevel.WARNING)
-            self.__logger.log("Full name: " + test_case.get("fullname"))
-            result_status = test_case.get("result")
-            self.__logger.log("Status: " + result_status,
-                              LogLevel.SUCCESS if result_status == "Passed" else LogLevel.ERROR)
+            self.__logger.log("Test case ID: " + str(test_case.id), LogLevel.WARNING)
+            self.__logger.log("Full name: " + test_case.name)
+            self.__logger.log("Status: " + test_case.outcome,
+                              LogLevel.SUCCESS if test_case.outcome == "Passed" else LogLevel.ERROR)
             self.__logger.log_linebreaks(1)
+            yield test_case
 
 
     def __exit_with_error(self, error_code, error_msg, usage_info = None):
@@ -118,6 +406,7 @@ class UnityTester:
                           LogLevel.ERROR)
         if usage_info is not None:
             self.__logger.log(usage_info, LogLevel.WARNING)
+        self.__logger.flush()
         exit(error_code)
 
 